@@ -0,0 +1,98 @@
+"""Check that the package imports quickly and that an idle run exits early.
+
+``wdpv-process-and-dump`` is meant to be run often, and most runs find no
+new hourly files.  Such runs should not pay for importing numpy or
+toolforge, or for connecting to any database.
+
+Idle runs are measured both against a ``sqlite:`` database, and with the
+default (MariaDB) database and a newest file already noted in the work
+directory, which must not import toolforge.  The first run after a new
+file arrives does query MariaDB, which needs Toolforge and is not measured.
+
+Each measurement runs in a fresh interpreter, so that nothing is already
+imported or cached.
+
+Example::
+    python benchmarks/startup.py
+    # -> sqlite: import 0.048s, idle main 0.004s
+    # -> mariadb: import 0.047s, idle main 0.001s
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+IMPORT_BUDGET = 0.5 # Seconds
+IDLE_BUDGET = 0.5 # Seconds
+UNLOADED = ('numpy', 'toolforge', 'tenacity', 'requests')
+
+CHILD = """
+import json, sys, time
+t = time.perf_counter()
+import wikidata_pageviews
+t_import = time.perf_counter() - t
+t = time.perf_counter()
+wikidata_pageviews.main(sys.argv[1:])
+t_main = time.perf_counter() - t
+print(json.dumps(dict(import_seconds=t_import, main_seconds=t_main,
+                      loaded=[ m for m in {unloaded} if m in sys.modules ])))
+"""
+
+
+def measure(repo, config):
+    """Time ``import wikidata_pageviews`` and an idle ``main()`` in a fresh interpreter
+
+    Args:
+        repo: Directory containing the package
+        config: ``sqlite`` for an empty logs directory and a local database, or
+            ``mariadb`` for the default database with its newest file already processed
+
+    Returns:
+        result: Dictionary of ``import_seconds``, ``main_seconds``, and the
+            modules of ``UNLOADED`` that were ``loaded``
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        logs = tmp / 'logs'
+        logs.mkdir()
+        argv = [ str(logs), '--work-dir', str(tmp / 'work'), '-o', str(tmp / 'dump.json') ]
+        if config == 'sqlite':
+            argv += [ '--db', f"sqlite:{tmp / 'wdpv.db'}" ]
+        else:
+            from wikidata_pageviews.constants import DEFAULT_DATABASE
+            from wikidata_pageviews.process_log import idle_marker
+            file = logs / time.strftime('%Y/%Y-%m/pageviews-%Y%m%d-%H0000.gz', time.gmtime())
+            file.parent.mkdir(parents=True)
+            file.touch()
+            marker = idle_marker(tmp / 'work')
+            marker.parent.mkdir(parents=True)
+            marker.write_text(json.dumps({ DEFAULT_DATABASE: file.name }))
+        output = subprocess.run([ sys.executable, '-c', CHILD.format(unloaded=UNLOADED), *argv ],
+                                cwd=repo, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help="Number of runs, of which the fastest is reported")
+    args = parser.parse_args(argv)
+    repo = Path(__file__).resolve().parent.parent
+    sys.path.insert(0, str(repo))
+    for config in ('sqlite', 'mariadb'):
+        results = [ measure(repo, config) for _ in range(args.repeat) ]
+        import_seconds = min(result['import_seconds'] for result in results)
+        main_seconds = min(result['main_seconds'] for result in results)
+        loaded = sorted(set().union(*(result['loaded'] for result in results)))
+        print(f"{config}: import {import_seconds:.3f}s, idle main {main_seconds:.3f}s")
+        assert not loaded, f"Idle {config} run imported {', '.join(loaded)}"
+        assert import_seconds <= IMPORT_BUDGET, f"Import took {import_seconds:.3f}s"
+        assert main_seconds <= IDLE_BUDGET, f"Idle {config} main took {main_seconds:.3f}s"
+
+
+if __name__ == '__main__':
+    main()
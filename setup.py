@@ -12,7 +12,9 @@ setup(name='wikidata_pageviews',
       entry_points = {
           'console_scripts': [
               'wdpv-process-file=wikidata_pageviews.process_log:main',
+              'wdpv-remap=wikidata_pageviews.process_log:remap',
               'wdpv-dump=wikidata_pageviews.dump:main',
+              'wdpv-timeseries=wikidata_pageviews.timeseries:main',
               'wdpv-process-and-dump=wikidata_pageviews:main',
               'wdpv-grid-monitor=wikidata_pageviews.grid:monitor',
           ],
@@ -0,0 +1,97 @@
+"""Fixtures for running the pipeline without Toolforge.
+
+The sitematrix is replaced by a fixed set of databases, and title lookups
+by a deterministic fake resolver, so that everything else (parsing,
+chunking, aggregation, and the ``sqlite:`` and ``archive:`` backends) runs
+for real on small synthetic log files.
+"""
+
+import gzip
+import random
+import re
+from collections import Counter
+
+import pytest
+
+from wikidata_pageviews import project, process_log
+
+DATABASES = {'enwiki', 'dewiki', 'frwiki', 'frwiktionary', 'commonswiki', 'wikidatawiki'}
+PROJECTS = ['en', 'en.m', 'de', 'fr.m', 'fr.d', 'commons.m', 'wd', 'www.wd', 'xx.unknown']
+HOURS = ['20181021-000000', '20181021-010000', '20181021-020000']
+
+TITLE_RE = re.compile(r'^Title_(\d+)$')
+
+
+def fake_resolver(modulus=5):
+    """Returns a stand-in for ``convert_titles_to_qids``
+
+    ``Title_N`` resolves to a QID derived from the database and N, except
+    when N is a multiple of ``modulus``; anything else is unresolved.
+    """
+    def convert_titles_to_qids(dbname, titles):
+        results = []
+        for title in titles:
+            m = TITLE_RE.search(title)
+            if m is None or int(m.group(1)) % modulus == 0:
+                results.append(None)
+            else:
+                results.append((int(m.group(1)) * 7 + len(dbname)) % 997 + 1)
+        return results
+    return convert_titles_to_qids
+
+
+def write_log(path, seed, n_lines=5000):
+    """Write a synthetic hourly pageview file"""
+    rng = random.Random(seed)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, 'wb') as f:
+        for _ in range(n_lines):
+            p = rng.choice(PROJECTS)
+            title = f"Q{rng.randint(1, 300)}" if 'wd' in p else f"Title_{rng.randint(1, 2000)}"
+            f.write(f"{p} {title} {rng.randint(1, 50)} 0\n".encode())
+
+
+def expected_views(file, convert_titles_to_qids):
+    """Reference aggregation of a log file, one line at a time
+
+    Returns:
+        views: Counter of views by QID, with unconverted views under 0
+    """
+    views = Counter()
+    with gzip.open(file) as f:
+        for line in f:
+            p, title, v, _ = line.decode().split(' ')
+            dbname = project.database_from_project_name(p)
+            if dbname is None:
+                qid = None
+            elif dbname == 'wikidatawiki':
+                qid = int(title[1:])
+            else:
+                (qid,) = convert_titles_to_qids(dbname, [title])
+            views[qid or 0] += int(v)
+    return views
+
+
+@pytest.fixture(autouse=True)
+def databases(monkeypatch):
+    """Known databases, instead of fetching the sitematrix"""
+    monkeypatch.setattr(project, '_databases', set(DATABASES))
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    """Fake replica lookups; returns the function used"""
+    convert_titles_to_qids = fake_resolver()
+    monkeypatch.setattr(process_log, 'convert_titles_to_qids', convert_titles_to_qids)
+    return convert_titles_to_qids
+
+
+@pytest.fixture
+def log_files(tmp_path):
+    """Three synthetic hourly files, laid out as in the dumps directory"""
+    files = []
+    for i, hour in enumerate(HOURS):
+        file = tmp_path / 'dumps' / '2018' / '2018-10' / f"pageviews-{hour}.gz"
+        write_log(file, seed=i)
+        files.append(file)
+    return files
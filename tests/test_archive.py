@@ -0,0 +1,72 @@
+import numpy as np
+
+from wikidata_pageviews.archive import write_hour_file, read_hour_file, merge_sum, Archive
+from wikidata_pageviews.dump import get_dump, get_top, get_unresolved
+from wikidata_pageviews.process_log import process_files
+from wikidata_pageviews.writer import get_writer
+
+
+def test_hour_file_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    qids = np.unique(rng.integers(0, 1 << 30, 10000))
+    views = rng.integers(1, 1 << 40, len(qids))
+    path = tmp_path / '20181021-12.wdpvh'
+    write_hour_file(path, qids, views)
+    read_qids, read_views = read_hour_file(path)
+    assert np.array_equal(read_qids, qids)
+    assert np.array_equal(read_views, views)
+    write_hour_file(path, [], [])
+    assert [ len(x) for x in read_hour_file(path) ] == [0, 0]
+
+
+def test_merge_sum():
+    rng = np.random.default_rng(1)
+    parts = []
+    expected = dict()
+    for _ in range(5):
+        qids = np.unique(rng.integers(0, 1000, 300))
+        views = rng.integers(1, 100, len(qids))
+        parts.append((qids, views))
+        for qid, v in zip(qids.tolist(), views.tolist()):
+            expected[qid] = expected.get(qid, 0) + v
+    qids, views = merge_sum(parts)
+    assert dict(zip(qids.tolist(), views.tolist())) == expected
+    assert np.all(np.diff(qids) > 0)
+
+
+def test_archive_matches_sqlite(tmp_path, resolver, log_files):
+    sqlite = f"sqlite:{tmp_path / 'wdpv.db'}"
+    archive = f"archive:{tmp_path / 'archive'}"
+    for database in (sqlite, archive):
+        process_files(log_files, database, writer=get_writer(database))
+    with Archive(tmp_path / 'archive') as source:
+        assert source.latest_hour() == '2018-10-21 02:00:00'
+        assert len(source.hours('2018-10-21 00:00:00', '2018-10-21 23:00:00')) == len(log_files)
+    window = dict(start='2018-10-21T00', end='2018-10-21T02')
+    for mode in (None, 'logprobs'):
+        sqlite_summary, sqlite_data = get_dump(sqlite, mode=mode, **window)
+        archive_summary, archive_data = get_dump(archive, mode=mode, **window)
+        assert archive_data == sqlite_data
+        assert archive_summary == sqlite_summary
+    assert get_top(archive, n=20, **window) == get_top(sqlite, n=20, **window)
+    assert get_top(archive, n=20, approximate=True, **window) \
+        == get_top(sqlite, n=20, approximate=True, **window)
+    assert get_unresolved(archive, n=20, **window) == get_unresolved(sqlite, n=20, **window)
+    assert get_dump(archive, mode='sketch', **window) == get_dump(sqlite, mode='sketch', **window)
+
+
+def test_manifest(tmp_path, resolver, log_files):
+    database = f"archive:{tmp_path / 'archive'}"
+    process_files(log_files[:2], database, writer=get_writer(database))
+    archive = Archive(tmp_path / 'archive')
+    rows = archive.rows()
+    assert len(rows) == 2
+    for hour, row in rows.items():
+        assert set(row) == { 'file', 'hour', 'processed', 'duration', 'views', 'max_qid',
+                            'n_qids', 'remapped', 'sketch' }
+        assert archive.top_file(hour).exists() and archive.unresolved_file(hour).exists()
+    assert archive.heavy_hitters('2018-10-21 00:00:00', '2018-10-21 00:00:00')
+    assert archive.unresolved('2018-10-21 00:00:00', '2018-10-21 00:00:00')
+    assert archive.rows() is rows # Unchanged manifest is not parsed again
+    process_files(log_files[2:], database)
+    assert len(archive.rows()) == 3
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from wikidata_pageviews.dump import (compute_logprobs, parse_args, open_source, sketch_periods,
+                                     hour_sketches, load_rollup, merge_sketches, merge_all)
+from wikidata_pageviews.process_log import process_files
+from wikidata_pageviews.writer import get_writer
+
+
+def test_compute_logprobs():
+    logprobs, default_logprob = compute_logprobs(np.array([0, 3, 6]), 2, 9, smoothing=1.0)
+    assert np.allclose(np.exp(logprobs), [1/12, 4/12, 7/12])
+    assert np.isclose(np.exp(default_logprob), 1/12)
+
+
+@pytest.mark.parametrize('smoothing', [0, -1])
+def test_smoothing_must_be_positive(smoothing):
+    with pytest.raises(AssertionError):
+        compute_logprobs(np.array([1]), 1, 1, smoothing)
+    with pytest.raises(SystemExit):
+        parse_args(['--mode', 'logprobs', '--smoothing', str(smoothing)])
+
+
+def test_sketch_periods():
+    assert sketch_periods('2018-09-30 22:00:00', '2018-12-02 03:00:00') == [
+        (None, '2018-09-30 22:00:00', '2018-09-30 23:00:00'),
+        ('2018-10', '2018-10-01 00:00:00', '2018-10-31 23:00:00'),
+        ('2018-11', '2018-11-01 00:00:00', '2018-11-30 23:00:00'),
+        ('2018-12-01', '2018-12-01 00:00:00', '2018-12-01 23:00:00'),
+        (None, '2018-12-02 00:00:00', '2018-12-02 03:00:00'),
+    ]
+    assert [ period for period, _, _ in sketch_periods('2018-10-01 00:00:00', 
+                                                       '2018-10-31 23:00:00', months=False) ] \
+        == [ f"2018-10-{day:02d}" for day in range(1, 32) ]
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'archive'])
+def test_sketch_rollups(tmp_path, resolver, log_files, backend):
+    database = f"{backend}:{tmp_path / backend}"
+    writer = get_writer(database)
+    process_files(log_files, database, writer=writer)
+    day = ('2018-10-21 00:00:00', '2018-10-21 23:00:00')
+
+    def check():
+        with open_source(database) as cursor:
+            expected = merge_all(hour_sketches(cursor, *day)).counts
+            assert np.array_equal(merge_sketches(cursor, *day).counts, expected)
+            (revision, rollup) = load_rollup(cursor, '2018-10-21')
+            assert np.array_equal(rollup.counts, expected)
+        return revision
+
+    revision = check()
+    # Rewriting an hour makes the rollup stale
+    writer.write_hour(log_files[0].name, '2018-10-21T00:00:00', [(1, 1)], 0, replace_hour=True)
+    assert check() != revision
@@ -0,0 +1,105 @@
+import datetime
+import itertools
+import sys
+
+from wikidata_pageviews.grid import job_status, ingestion_status, monitor_jobs
+from wikidata_pageviews.writer import connect
+
+QSTAT_XML = """<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>101</JB_job_number>
+      <JB_name>wdpv</JB_name>
+      <state>r</state>
+    </job_list>
+  </queue_info>
+</job_info>
+"""
+
+NOW = datetime.datetime(2018, 10, 21, 12, 30)
+
+
+def fake_qstat(tmp_path):
+    """An executable that prints a fixed job list, as ``qstat -xml`` would"""
+    (tmp_path / 'qstat.xml').write_text(QSTAT_XML)
+    qstat = tmp_path / 'qstat'
+    qstat.write_text(f"#!{sys.executable}\n"
+                     f"import sys\n"
+                     f"assert sys.argv[1:] == ['-xml']\n"
+                     f"sys.stdout.write(open({str(tmp_path / 'qstat.xml')!r}).read())\n")
+    qstat.chmod(0o755)
+    return str(qstat)
+
+
+def touch_logs(dir, hours):
+    for hour in hours:
+        file = dir / hour.strftime('%Y') / hour.strftime('%Y-%m') \
+            / hour.strftime('pageviews-%Y%m%d-%H0000.gz')
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.touch()
+
+
+def add_hours(database, rows):
+    """Insert ``hours`` rows of (hour, processed, duration, remapped)"""
+    with connect(database) as cursor:
+        for hour, processed, duration, remapped in rows:
+            cursor.execute("INSERT OR REPLACE INTO hours "
+                           "(file, hour, processed, duration, views, max_qid, n_qids, remapped) "
+                           "VALUES (?, ?, ?, ?, 0, 0, 0, ?)",
+                           (hour.strftime('pageviews-%Y%m%d-%H0000.gz'), str(hour),
+                            str(processed), duration, remapped))
+
+
+def test_job_status(tmp_path):
+    assert [ tuple(job) for job in job_status(fake_qstat(tmp_path)) ] \
+        == [ ('101', 'wdpv', 'r', 'running') ]
+
+
+def test_ingestion_status(tmp_path):
+    database = f"sqlite:{tmp_path / 'wdpv.db'}"
+    logs = tmp_path / 'logs'
+    hour = datetime.timedelta(hours=1)
+    touch_logs(logs, [ NOW.replace(minute=0) - i * hour for i in range(6) ])
+    add_hours(database, [
+        (NOW.replace(minute=0) - 4 * hour, NOW - 3 * hour, 100, 0),
+        (NOW.replace(minute=0) - 3 * hour, NOW - 0.5 * hour, 200, 0),
+        (NOW.replace(minute=0) - 2 * hour, NOW - 0.2 * hour, 400, 0),
+        # A remap of an old hour is not ingestion
+        (NOW.replace(minute=0) - 40 * hour, NOW - 0.1 * hour, 10, 1),
+    ])
+    status = ingestion_status(database, logs, NOW)
+    assert status.latest_file_hour == NOW.replace(minute=0)
+    assert status.latest_db_hour == NOW.replace(minute=0) - 2 * hour
+    assert status.lag_hours == 2
+    assert (status.hours_per_hour, status.avg_duration) == (2, 300)
+    assert status.remapped_per_hour == 1
+    assert status.file_age_hours == 0.5
+
+
+def test_monitor_jobs(tmp_path):
+    database = f"sqlite:{tmp_path / 'wdpv.db'}"
+    logs = tmp_path / 'logs'
+    logs.mkdir()
+    hour = datetime.timedelta(hours=1)
+    clock = [NOW]
+    delays = []
+
+    def sleep(secs):
+        delays.append(secs)
+        clock[0] += hour
+
+    messages = monitor_jobs(sleep_secs=60, qstat=fake_qstat(tmp_path), database=database,
+                            dir=logs, lag_threshold=3, stale_threshold=3, sleep=sleep,
+                            clock=lambda: clock[0])
+    first = list(itertools.islice(messages, 3))
+    assert first[0] == "New job 101 (wdpv): state=running"
+    assert first[1].startswith("Ingestion: newest file None")
+    assert first[2] == f"ALERT: no pageview files in {logs}"
+    # Files appear, but are not processed
+    touch_logs(logs, [ NOW.replace(minute=0) + i * hour for i in range(2) ])
+    assert next(messages).startswith(f"Ingestion: newest file {NOW.replace(minute=0) + hour}")
+    assert next(messages) == "Recovered: newest pageview file is 0.5h old"
+    # The feed then stalls as the clock moves on
+    assert next(messages) == "ALERT: newest pageview file is 3.5h old, exceeding 3h"
+    assert delays == [60, 60, 120, 240]
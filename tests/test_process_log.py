@@ -0,0 +1,94 @@
+import sqlite3
+
+import pytest
+
+from wikidata_pageviews.process_log import process_file, process_files, file_hour, get_pending_files
+from wikidata_pageviews.writer import get_writer, sql_hour
+
+from conftest import expected_views
+
+
+def table(path, sql):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(sql).fetchall()
+
+
+def hour_views(path, hour):
+    return dict(table(path, f"SELECT qid, views FROM qid_hourly_views WHERE hour = '{hour}'"))
+
+
+@pytest.mark.parametrize('parse_workers', [1, 2])
+def test_process_file(tmp_path, resolver, log_files, parse_workers):
+    path = tmp_path / 'wdpv.db'
+    database = f"sqlite:{path}"
+    file = log_files[0]
+    assert process_file(file, database, parse_workers=parse_workers)
+    hour = sql_hour(file_hour(file.name))
+    expected = expected_views(file, resolver)
+    assert hour_views(path, hour) == expected
+    ((filename, row_hour, views, max_qid, n_qids),) = \
+        table(path, "SELECT file, hour, views, max_qid, n_qids FROM hours")
+    assert (filename, row_hour) == (file.name, hour)
+    assert (views, max_qid, n_qids) == (sum(expected.values()), max(expected), len(expected))
+    # Already recorded
+    assert not process_file(file, database)
+
+
+def test_process_file_checkpoints(tmp_path, resolver, log_files):
+    path = tmp_path / 'wdpv.db'
+    work_dir = tmp_path / 'work'
+    file = log_files[0]
+    assert process_file(file, f"sqlite:{path}", work_dir, max_bytes=10000)
+    assert hour_views(path, sql_hour(file_hour(file.name))) == expected_views(file, resolver)
+    assert not (work_dir / file.name).exists() # Cleared once written
+
+
+def test_process_files(tmp_path, resolver, log_files):
+    path = tmp_path / 'wdpv.db'
+    database = f"sqlite:{path}"
+    assert process_files(log_files, database, writer=get_writer(database)) == len(log_files)
+    for file in log_files:
+        assert hour_views(path, sql_hour(file_hour(file.name))) == expected_views(file, resolver)
+    assert len(table(path, "SELECT * FROM hours")) == len(log_files)
+    assert process_files(log_files, database) == 0
+
+
+def test_unresolved(tmp_path, resolver, log_files):
+    path = tmp_path / 'wdpv.db'
+    file = log_files[0]
+    process_file(file, f"sqlite:{path}")
+    rows = table(path, "SELECT dbname, title, views, error FROM hourly_unresolved")
+    assert rows
+    for dbname, title, views, error in rows:
+        (qid,) = resolver(dbname.decode(), [title.decode()])
+        assert qid is None
+        assert 0 <= error <= views
+
+
+def test_idle_marker(tmp_path, log_files):
+    class Writer:
+        database = 's53865__wdpv_p'
+        queries = 0
+        recorded = set()
+
+        def existing(self, filenames):
+            self.queries += 1
+            return self.recorded & set(filenames)
+
+    writer = Writer()
+    files = sorted(log_files, reverse=True)
+    work_dir = tmp_path / 'work'
+    assert get_pending_files(files, writer, work_dir) == files
+    writer.recorded = { file.name for file in files[1:] }
+    assert get_pending_files(files, writer, work_dir) == files[:1]
+    writer.recorded.add(files[0].name)
+    assert get_pending_files(files, writer, work_dir) == []
+    assert writer.queries == 3
+    # Nothing new since, so the database is not queried
+    assert get_pending_files(files, writer, work_dir) == []
+    assert writer.queries == 3
+    assert get_pending_files(files, writer) == []
+    assert writer.queries == 4
+    newer = log_files[0].with_name('pageviews-20181021-030000.gz')
+    assert get_pending_files([newer] + files, writer, work_dir) == [newer]
+    assert writer.queries == 5
@@ -0,0 +1,86 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from wikidata_pageviews import process_log, project
+from wikidata_pageviews.batch import TitleBatch
+from wikidata_pageviews.process_log import process_file, remap_hours, open_title_store
+from wikidata_pageviews.titlestore import TitleStore
+
+from conftest import DATABASES, fake_resolver
+
+
+def views(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT hour, qid, views FROM qid_hourly_views "
+                            "ORDER BY hour, qid").fetchall()
+
+
+def hours(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT file, hour, views, max_qid, n_qids FROM hours "
+                            "ORDER BY hour").fetchall()
+
+
+def ingest(files, path, title_store=None):
+    for file in files:
+        assert process_file(file, f"sqlite:{path}", title_store=title_store)
+
+
+def test_remap_round_trip(tmp_path, resolver, log_files):
+    title_store = open_title_store(tmp_path / 'titles')
+    ingest(log_files, tmp_path / 'ingested.db', title_store)
+    # Remapping with the same resolver reproduces the ingested hours
+    assert remap_hours(title_store, f"sqlite:{tmp_path / 'remapped.db'}", batch_hours=2) \
+        == len(log_files)
+    assert views(tmp_path / 'remapped.db') == views(tmp_path / 'ingested.db')
+    assert hours(tmp_path / 'remapped.db') == hours(tmp_path / 'ingested.db')
+
+
+def test_remap_after_resolver_change(tmp_path, resolver, log_files, monkeypatch):
+    title_store = open_title_store(tmp_path / 'titles')
+    database = f"sqlite:{tmp_path / 'wdpv.db'}"
+    ingest(log_files, tmp_path / 'wdpv.db', title_store)
+    before = views(tmp_path / 'wdpv.db')
+    # Sitelinks change, so that different titles resolve
+    monkeypatch.setattr(process_log, 'convert_titles_to_qids', fake_resolver(modulus=3))
+    remap_hours(title_store, database, start='2018-10-21T01')
+    ingest(log_files[1:], tmp_path / 'fresh.db')
+    after = views(tmp_path / 'wdpv.db')
+    assert after != before
+    assert [ row for row in after if row[0] >= '2018-10-21 01' ] == views(tmp_path / 'fresh.db')
+    assert [ row for row in after if row[0] < '2018-10-21 01' ] \
+        == [ row for row in before if row[0] < '2018-10-21 01' ]
+
+
+def test_remap_after_mapping_change(tmp_path, resolver, log_files, monkeypatch):
+    # fr.d cannot be mapped until its database is known
+    monkeypatch.setattr(project, '_databases', DATABASES - {'frwiktionary'})
+    title_store = open_title_store(tmp_path / 'titles')
+    database = f"sqlite:{tmp_path / 'wdpv.db'}"
+    ingest(log_files, tmp_path / 'wdpv.db', title_store)
+    before = views(tmp_path / 'wdpv.db')
+    monkeypatch.setattr(project, '_databases', set(DATABASES))
+    assert remap_hours(title_store, database) == len(log_files)
+    ingest(log_files, tmp_path / 'fresh.db')
+    assert views(tmp_path / 'wdpv.db') != before
+    assert views(tmp_path / 'wdpv.db') == views(tmp_path / 'fresh.db')
+    assert hours(tmp_path / 'wdpv.db') == hours(tmp_path / 'fresh.db')
+
+
+def test_concurrent_title_ids(tmp_path):
+    stores = [ TitleStore(tmp_path / 'titles') for _ in range(4) ]
+    batches = [ [ f"Title_{i}" for i in range(k, 3000, k + 1) ] for k in range(len(stores)) ]
+
+    def add(store, titles):
+        batch = TitleBatch()
+        for title in titles:
+            batch.append(title.encode(), 1)
+        return store.add('en', batch).tolist()
+
+    with ThreadPoolExecutor(len(stores)) as executor:
+        results = list(executor.map(add, stores, batches))
+    reopened = TitleStore(tmp_path / 'titles')
+    for titles, ids in zip(batches, results):
+        assert reopened.titles('en', ids) == titles
+    distinct = set().union(*batches)
+    assert sorted(set().union(*results)) == list(range(len(distinct)))
@@ -0,0 +1,60 @@
+from collections import Counter
+
+import numpy as np
+
+from wikidata_pageviews.sketch import SpaceSaving, CountMinSketch
+
+
+def test_space_saving():
+    rng = np.random.default_rng(0)
+    stream = (rng.zipf(1.5, 20000) % 1000).tolist()
+    counts = Counter(stream)
+    sketch = SpaceSaving(50)
+    for key in stream:
+        sketch.add(key)
+    for key, count, error in sketch.top():
+        assert count - error <= counts[key] <= count
+    for key, count in counts.items():
+        if key not in sketch.counters:
+            assert count <= sketch.minimum()
+
+
+def test_from_items_floor():
+    items = [ ('a', 5, 0), ('b', 3, 0) ]
+    assert SpaceSaving.from_items(items).minimum() == 3 # Assumed full
+    assert SpaceSaving.from_items(items, capacity=10).minimum() == 0
+    # Hours that never evicted anything merge exactly
+    merged = SpaceSaving.from_items(items, 10).merge(SpaceSaving.from_items([ ('c', 4, 0) ], 10))
+    assert merged.top() == [ ('a', 5, 0), ('c', 4, 0), ('b', 3, 0) ]
+
+
+def test_count_min_sketch():
+    rng = np.random.default_rng(1)
+    keys = np.unique(rng.integers(1, 1 << 26, 50000))
+    views = rng.integers(1, 100, len(keys))
+    sketch = CountMinSketch(1 << 12, 4)
+    # Updates take distinct keys, so a second hour is added separately
+    sketch.update(keys[::2], views[::2])
+    sketch.update(keys, views)
+    exact = views.copy()
+    exact[::2] *= 2
+    estimates = sketch.estimate(keys)
+    assert np.all(estimates >= exact)
+    assert np.mean(estimates - exact <= sketch.epsilon * exact.sum()) >= 1 - sketch.delta
+    restored = CountMinSketch.from_bytes(sketch.to_bytes(), sketch.width, sketch.depth)
+    assert np.array_equal(restored.estimate(keys), estimates)
+
+
+def test_fold_and_merge_widths():
+    rng = np.random.default_rng(2)
+    keys = np.unique(rng.integers(1, 1 << 26, 20000))
+    views = rng.integers(1, 100, len(keys))
+    wide, narrow = CountMinSketch(1 << 14, 4), CountMinSketch(1 << 12, 3)
+    wide.update(keys, views)
+    narrow.update(keys, views)
+    folded = wide.fold(1 << 12)
+    assert np.all(folded.estimate(keys) >= views)
+    merged = wide.merge(narrow)
+    assert (merged.width, merged.depth) == (1 << 12, 3)
+    assert np.all(merged.estimate(keys) >= 2 * views)
+    assert np.array_equal(merged.counts, wide.fold(1 << 12, 3).counts + narrow.counts)
@@ -0,0 +1,139 @@
+import re
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+
+from wikidata_pageviews import writer as writer_module
+from wikidata_pageviews.sketch import SpaceSaving
+from wikidata_pageviews.writer import get_writer, title_hash, SQLITE_SCHEMA
+
+HOUR = '2018-10-21T12:00:00'
+FILENAME = 'pageviews-20181021-120000.gz'
+
+LOAD_DATA_RE = re.compile(r"LOAD DATA\s+(?:\S+\s+)?LOCAL INFILE '([^']+)'\s+(REPLACE|IGNORE)?\s*"
+                          r"INTO TABLE (\w+)")
+
+
+class MariaDBCursor:
+    """Runs the MariaDB writers' statements against SQLite
+
+    Placeholders are translated, and ``LOAD DATA LOCAL INFILE`` is emulated
+    by reading the file, so that the SQL each writer sends is exercised.
+    """
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+        self.statements = []
+
+    def execute(self, sql, params=()):
+        self.statements.append(sql)
+        m = LOAD_DATA_RE.search(sql)
+        if m is None:
+            return self.cursor.execute(sql.replace('%s', '?'), params)
+        file, replace, table = m.groups()
+        with open(file) as f:
+            rows = [ line.rstrip('\n').split('\t') for line in f ]
+        placeholders = ', '.join('?' * len(rows[0])) if rows else ''
+        self.cursor.executemany(f"INSERT OR {replace or 'ABORT'} INTO {table} "
+                                f"VALUES ({placeholders})", rows)
+
+    def executemany(self, sql, rows):
+        self.statements.append(sql)
+        return self.cursor.executemany(sql.replace('%s', '?'), rows)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+@pytest.fixture
+def mariadb(tmp_path, monkeypatch):
+    """Points ``writer.connect`` for MariaDB names at a SQLite file; returns the cursors used"""
+    path = tmp_path / 'mariadb.db'
+    cursors = []
+
+    @contextmanager
+    def connect(database, **kargs):
+        conn = sqlite3.connect(path)
+        conn.executescript(SQLITE_SCHEMA)
+        cursor = MariaDBCursor(conn)
+        cursors.append((kargs, cursor))
+        yield cursor
+        conn.commit()
+        conn.close()
+
+    monkeypatch.setattr(writer_module, 'connect', connect)
+    return path, cursors
+
+
+def select(path, sql):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(sql).fetchall()
+
+
+def check_hour(path, qid_views, unresolved):
+    hour = '2018-10-21 12:00:00'
+    assert select(path, "SELECT qid, hour, views FROM qid_hourly_views ORDER BY qid") \
+        == [ (qid, hour, v) for qid, v in sorted(qid_views) ]
+    assert select(path, "SELECT file, hour, views, max_qid, n_qids FROM hours") \
+        == [ (FILENAME, hour, sum(v for _, v in qid_views), max(qid_views)[0], len(qid_views)) ]
+    assert select(path, "SELECT qid, views FROM hourly_top ORDER BY views DESC") \
+        == [ (qid, v) for qid, v in sorted(qid_views, key=lambda x: -x[1]) if qid != 0 ][:2]
+    assert sorted(select(path, "SELECT dbname, title_hash, title, views FROM hourly_unresolved")) \
+        == sorted((dbname.encode(), title_hash(title.encode()), title.encode(), v)
+                  for (dbname, title), v, _ in unresolved.top())
+    (width, depth) = select(path, "SELECT width, depth FROM hourly_sketch")[0]
+    assert width > 0 and depth > 0
+
+
+def sample():
+    qid_views = [ (42, 100), (0, 7), (5, 30), (1000000, 1) ]
+    unresolved = SpaceSaving(10)
+    unresolved.add(('enwiki', 'Foo'), 5)
+    unresolved.add(('enwiki', 'foo'), 3) # Differs only by case
+    unresolved.add(('enwiki', 'Bar\t\\' + 'x' * 300), 2)
+    return qid_views, unresolved
+
+
+@pytest.mark.parametrize('backend', ['load-data', 'insert'])
+def test_mariadb_writers(mariadb, backend):
+    path, cursors = mariadb
+    writer = get_writer('s53865__wdpv_p', backend, top_n=2)
+    qid_views, unresolved = sample()
+    assert not writer.exists(FILENAME)
+    writer.write_hour(FILENAME, HOUR, qid_views, 0, unresolved)
+    check_hour(path, qid_views, unresolved)
+    kargs, cursor = cursors[-1]
+    if backend == 'load-data':
+        assert kargs == dict(local_infile=1)
+        assert any(sql.startswith('LOAD DATA') for sql in cursor.statements)
+    else:
+        assert any(sql.startswith('REPLACE INTO qid_hourly_views') for sql in cursor.statements)
+    assert writer.exists(FILENAME)
+    assert writer.existing([FILENAME, 'pageviews-20181021-130000.gz']) == {FILENAME}
+    # Rewriting replaces rather than failing
+    writer.write_hour(FILENAME, HOUR, qid_views[:3], 0, unresolved, replace_hour=True)
+    check_hour(path, qid_views[:3], unresolved)
+
+
+def test_sqlite_writer(tmp_path):
+    path = tmp_path / 'wdpv.db'
+    writer = get_writer(f"sqlite:{path}", top_n=2, chunk_size=2)
+    qid_views, unresolved = sample()
+    writer.write_hour(FILENAME, HOUR, qid_views, 0, unresolved)
+    check_hour(path, qid_views, unresolved)
+    assert select(path, "SELECT remapped FROM hours") == [(0,)]
+    writer.write_hour(FILENAME, HOUR, qid_views[:3], 0, unresolved, replace_hour=True)
+    check_hour(path, qid_views[:3], unresolved)
+    assert select(path, "SELECT remapped FROM hours") == [(1,)]
+    assert writer.existing([FILENAME]) == {FILENAME}
+
+
+def test_get_writer():
+    with pytest.raises(AssertionError):
+        get_writer('sqlite:/tmp/wdpv.db', 'insert')
+    with pytest.raises(AssertionError):
+        get_writer('s53865__wdpv_p', 'sqlite')
+    assert type(get_writer('s53865__wdpv_p', 'insert')).__name__ == 'InsertWriter'
@@ -1,14 +1,18 @@
 """Main driver to process unprocessed logfiles and write out the result file.
+
+Most runs find nothing new to do, so that case is detected with a directory
+scan, before importing numpy or fetching the sitematrix, and (once the newest
+file is known to be processed) without connecting to the database.
 """
 import sys
 import argparse
 import logging
 import gc
 
-from .process_log import get_files, process_file
+from .process_log import get_files, get_pending_files, process_file, open_title_store
 from .util import iterate_until_n_succeed
 from .constants import *
-from .dump import write_combination_file
+from .writer import get_writer, WRITERS
 
 def parse_args(argv=None):
     """Wrapper for argparse.ArgumentParser()"""
@@ -23,6 +27,20 @@ def parse_args(argv=None):
                         help="Maximum number of files to process")
     parser.add_argument("--maxdays", type=int, default=7, 
                         help="Maximum age of file to process in days")
+    parser.add_argument("--work-dir", type=Path, default=DEFAULT_WORK_DIR,
+                        help="Directory for checkpoints to resume interrupted files")
+    parser.add_argument("--no-checkpoints", dest='work_dir', action='store_const', const=None,
+                        help="Disable checkpoints")
+    parser.add_argument("--resolve-workers", type=int, default=1,
+                        help="Number of threads resolving titles against the replicas (0 for none)")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Maximum number of items queued between pipeline stages")
+    parser.add_argument("--writer", choices=WRITERS.keys(), default=None,
+                        help="Bulk-write backend (default depends on database name)")
+    parser.add_argument("--write-chunk-size", type=int, default=None,
+                        help="Number of rows to write at once")
+    parser.add_argument("--title-store", type=Path, default=None,
+                        help="Directory in which to keep title views for later remapping")
     parser.add_argument("-o", '--output', type=Path, default=DEFAULT_OUTPUT,
                         help="File to write output to")
     args = parser.parse_args(argv)
@@ -39,10 +57,20 @@ def parse_args(argv=None):
 def main(argv=None):
     """Console script entry point"""
     args = parse_args(argv)
-    files = get_files(args.dir, args.maxdays)
+    writer = get_writer(args.database, args.writer, args.write_chunk_size)
+    files = get_pending_files(get_files(args.dir, args.maxdays), writer, args.work_dir)
+    if args.max_files > 0 and not files:
+        logging.getLogger(__name__).info("Nothing to do")
+        return
+    from .dump import write_combination_file # Imported on demand as it needs numpy
+    title_store = open_title_store(args.title_store)
     n = 0
     if args.max_files > 0:
-        n = iterate_until_n_succeed(lambda file: process_file(file, args.database), 
+        n = iterate_until_n_succeed(lambda file: process_file(file, args.database, args.work_dir,
+                                                              workers=args.resolve_workers,
+                                                              max_pending=args.queue_size,
+                                                              writer=writer,
+                                                              title_store=title_store), 
                                     files, args.max_files)
     if args.max_files == 0 or n > 0:
         if n > 0:
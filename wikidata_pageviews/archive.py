@@ -0,0 +1,353 @@
+"""Columnar storage of hourly results as immutable files.
+
+This is an alternative to keeping every (qid, hour, views) row in MariaDB.
+Each processed hour is written as a single file holding the QIDs in sorted
+order, delta-encoded and compressed, followed by the compressed views.
+A manifest (``manifest.jsonl``) mirrors the ``hours`` table.  Beside each
+hour file are its heavy hitters (``.top.json``), its sketch of unresolved
+titles (``.unresolved.json``), and a Count-Min sketch of its views (``.cms``),
+so that the manifest stays small enough to re-read whenever it changes.
+Daily and monthly merges of the sketches are kept in ``rollups``.
+
+Ranges of hours are aggregated locally by reading the relevant files and
+merging them with vectorized sums.
+
+Archive directories are referred to by database names like ``archive:DIR``.
+
+Example::
+    with Archive('/data/wdpv') as archive:
+        qids, views = archive.aggregate('2018-10-10 00:00:00', '2018-10-10 23:00:00')
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from .writer import Writer, sql_hour, utc_timestamp, heavy_hitters, hour_sketch
+from .sketch import CountMinSketch
+
+ARCHIVE_PREFIX = 'archive:'
+
+# Magic, number of QIDs, and compressed lengths of the QID and views blocks
+HEADER = struct.Struct('<8sQQQ')
+MAGIC = b'WDPVHR1\0'
+
+
+def is_archive(database):
+    """Returns true iff the database name refers to an archive directory"""
+    return database.startswith(ARCHIVE_PREFIX)
+
+
+def archive_path(database):
+    """Returns directory for a database name like ``archive:DIR``"""
+    assert is_archive(database), f"Expected a database name like {ARCHIVE_PREFIX}DIR: {database}"
+    return Path(database[len(ARCHIVE_PREFIX):])
+
+
+def write_hour_file(path, qids, views):
+    """Write a single hour's results
+
+    Args:
+        path: File to write
+        qids: Sorted array of distinct QIDs
+        views: Parallel array of views
+    """
+    qids = np.asarray(qids, dtype=np.int64)
+    deltas = np.diff(qids, prepend=0).astype('<u4')
+    qid_block = zlib.compress(deltas.tobytes())
+    views_block = zlib.compress(np.asarray(views, dtype='<u8').tobytes())
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(qids), len(qid_block), len(views_block)))
+        f.write(qid_block)
+        f.write(views_block)
+    os.replace(tmp, path)
+
+
+def read_hour_file(path):
+    """Read a single hour's results
+
+    The blocks are compressed, so the file is read whole rather than
+    memory-mapped: every byte has to be decompressed anyway.
+
+    Returns:
+        qids: Sorted int64 array of QIDs
+        views: Parallel int64 array of views
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, n, qid_length, views_length = HEADER.unpack_from(data)
+    assert magic == MAGIC, f"{path} is not an hourly archive file"
+    with memoryview(data) as buffer:
+        offset = HEADER.size
+        deltas = zlib.decompress(buffer[offset:offset+qid_length])
+        offset += qid_length
+        views = zlib.decompress(buffer[offset:offset+views_length])
+    qids = np.cumsum(np.frombuffer(deltas, dtype='<u4'), dtype=np.int64)
+    views = np.frombuffer(views, dtype='<u8').astype(np.int64)
+    assert len(qids) == n == len(views)
+    return (qids, views)
+
+
+def write_sidecar(path, data:bytes):
+    """Atomically write a file beside an hour file"""
+    tmp = path.with_name(path.name + '.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def merge_sum(parts):
+    """Sum several sparse vectors, each given as sorted (qids, views) arrays
+
+    Parts are merged pairwise, so the cost is proportional to the total size
+    times the logarithm of the number of parts.
+
+    Args:
+        parts: List of (qids, views) pairs with sorted, distinct QIDs
+
+    Returns:
+        qids: Sorted array of distinct QIDs
+        views: Parallel array of total views
+    """
+    parts = list(parts)
+    if not parts:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    while len(parts) > 1:
+        merged = []
+        for i in range(0, len(parts) - 1, 2):
+            (qids_a, views_a), (qids_b, views_b) = parts[i], parts[i+1]
+            qids = np.concatenate([qids_a, qids_b])
+            views = np.concatenate([views_a, views_b])
+            # For int64 keys, numpy's stable sort is timsort, which finds the
+            # two sorted runs and merges them in a single linear pass (measured
+            # faster than placing each run by binary search in the other)
+            order = np.argsort(qids, kind='stable')
+            qids = qids[order]
+            views = views[order]
+            if len(qids):
+                starts = np.flatnonzero(np.concatenate([[True], qids[1:] != qids[:-1]]))
+                qids = qids[starts]
+                views = np.add.reduceat(views, starts)
+            merged.append((qids, views))
+        if len(parts) % 2:
+            merged.append(parts[-1])
+        parts = merged
+    return parts[0]
+
+
+class Archive:
+    """Directory of hourly files and their manifest
+
+    Can be used as a context manager for symmetry with database cursors.
+
+    Args:
+        path: Archive directory
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self._rows = (None, dict()) # Manifest (mtime, size) and parsed rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def manifest_file(self):
+        return self.path / 'manifest.jsonl'
+
+    def rows(self):
+        """Returns manifest rows (as dicts) by hour
+
+        The manifest is only parsed again when its modification time or size
+        has changed.  The result should not be modified.
+        """
+        try:
+            stat = os.stat(self.manifest_file)
+        except FileNotFoundError:
+            return dict()
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached_key, results = self._rows
+        if key != cached_key:
+            results = dict()
+            with open(self.manifest_file) as f:
+                for line in f:
+                    if line.strip():
+                        row = json.loads(line)
+                        results[row['hour']] = row # Later rows supersede earlier ones
+            self._rows = (key, results)
+        return results
+
+    def append_row(self, row):
+        """Add a row to the manifest"""
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_file, 'a') as f:
+            f.write(json.dumps(row) + "\n")
+
+    def hour_file(self, hour):
+        """Path of file for an hour like "2018-10-10 01:00:00" """
+        return self.path / (hour[:10].replace('-', '') + '-' + hour[11:13] + '.wdpvh')
+
+    def sketch_file(self, hour):
+        """Path of Count-Min sketch file for an hour"""
+        return self.hour_file(hour).with_suffix('.cms')
+
+    def top_file(self, hour):
+        """Path of heavy hitters file for an hour"""
+        return self.hour_file(hour).with_suffix('.top.json')
+
+    def unresolved_file(self, hour):
+        """Path of unresolved titles file for an hour"""
+        return self.hour_file(hour).with_suffix('.unresolved.json')
+
+    def _sidecar(self, hour, row, name, file):
+        """Contents of an hour's JSON sidecar, or of its manifest row as once written"""
+        if name in row:
+            return row[name]
+        try:
+            with open(file(hour)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def latest_hour(self):
+        """Returns the last available hour, or None"""
+        return max(self.rows(), default=None)
+
+    def hours(self, start, end):
+        """Returns sorted list of available hours in the closed range"""
+        return sorted(hour for hour in self.rows() if start <= hour <= end)
+
+    def revisions(self, start, end):
+        """Returns (hour, processed, views, n_qids) for each available hour in the range"""
+        return sorted((hour, row['processed'], row['views'], row['n_qids'])
+                      for hour, row in self.rows().items() if start <= hour <= end)
+
+    def summary(self, start, end):
+        """Returns (max_qid, total views) over the range, as for ``dump.get_summary``"""
+        rows = [ row for hour, row in self.rows().items() if start <= hour <= end ]
+        return (max((row['max_qid'] for row in rows), default=0),
+                float(sum(row['views'] for row in rows)))
+
+    def heavy_hitters(self, start, end):
+        """Returns the heavy hitters recorded for each hour in the range
+
+        Returns:
+            top: List of (hour, qid, views) triples
+        """
+        return [ (hour, qid, views) for hour, row in self.rows().items() if start <= hour <= end
+                 for qid, views in self._sidecar(hour, row, 'top', self.top_file) ]
+
+    def unresolved(self, start, end):
+        """Returns the sketches of unresolved titles recorded for each hour in the range
+        
+        Returns:
+            unresolved: List of (hour, dbname, title, views, error) tuples
+        """
+        return [ (hour, dbname, title, views, error) 
+                 for hour, row in self.rows().items() if start <= hour <= end
+                 for dbname, title, views, error 
+                 in self._sidecar(hour, row, 'unresolved', self.unresolved_file) ]
+
+    def rollup(self, period):
+        """Returns the (revision, ``CountMinSketch``) saved for a day or month, or None"""
+        try:
+            header, data = (self.path / 'rollups' / f"{period}.cms").read_bytes().split(b'\n', 1)
+        except FileNotFoundError:
+            return None
+        meta = json.loads(header)
+        return (bytes.fromhex(meta['revision']),
+                CountMinSketch.from_bytes(data, meta['width'], meta['depth']))
+
+    def save_rollup(self, period, revision, sketch):
+        """Save the merged sketch of a day or month, as of a revision of its hours"""
+        meta = dict(revision=revision.hex(), width=sketch.width, depth=sketch.depth)
+        file = self.path / 'rollups' / f"{period}.cms"
+        file.parent.mkdir(parents=True, exist_ok=True)
+        write_sidecar(file, json.dumps(meta).encode() + b'\n' + sketch.to_bytes())
+
+    def sketches(self, start, end):
+        """Yields the Count-Min sketch recorded for each hour in the range"""
+        for hour, row in sorted(self.rows().items()):
+            if start <= hour <= end and 'sketch' in row:
+                width, depth = row['sketch']
+                yield CountMinSketch.from_bytes(self.sketch_file(hour).read_bytes(), width, depth)
+
+    def series(self, qids, hours):
+        """Views of some QIDs in each of some hours
+        
+        Args:
+            qids: Sorted array of distinct QIDs
+            hours: List of available hours
+            
+        Returns:
+            views: ``uint32`` matrix with a row for each QID and a column for each hour
+        """
+        qids = np.asarray(qids, dtype=np.int64)
+        results = np.zeros((len(qids), len(hours)), dtype=np.uint32)
+        for j, hour in enumerate(hours):
+            hour_qids, hour_views = read_hour_file(self.hour_file(hour))
+            i = np.minimum(np.searchsorted(hour_qids, qids), max(len(hour_qids) - 1, 0))
+            if len(hour_qids):
+                found = hour_qids[i] == qids
+                results[found, j] = hour_views[i[found]]
+        return results
+
+    def aggregate(self, start, end):
+        """Sum views by QID over a range of hours
+
+        Returns:
+            qids: Sorted array of distinct QIDs (including 0 for unconverted views)
+            views: Parallel array of total views
+        """
+        hours = self.hours(start, end)
+        logging.getLogger(__name__).info(f"Aggregating {len(hours)} hours from {self.path}")
+        return merge_sum(read_hour_file(self.hour_file(hour)) for hour in hours)
+
+
+class ArchiveWriter(Writer):
+    """Writes each hour as a file in an archive directory named like ``archive:DIR``"""
+    _lock = threading.Lock() # Serializes manifest updates between threads
+
+    def __init__(self, database, **kargs):
+        super().__init__(database, **kargs)
+        self.archive = Archive(archive_path(database))
+
+    def exists(self, filename):
+        return any(row['file'] == filename for row in self.archive.rows().values())
+
+    def existing(self, filenames):
+        return set(filenames) & { row['file'] for row in self.archive.rows().values() }
+
+    def write_hour(self, filename, hour, qid_views, start_time, unresolved=None,
+                   replace_hour=False):
+        # Each hour's file is always replaced as a whole
+        data = sorted(qid_views)
+        qids = np.fromiter((qid for qid, _ in data), dtype=np.int64, count=len(data))
+        views = np.fromiter((v for _, v in data), dtype=np.int64, count=len(data))
+        hour = sql_hour(hour)
+        self.archive.path.mkdir(parents=True, exist_ok=True)
+        write_hour_file(self.archive.hour_file(hour), qids, views)
+        sketch = hour_sketch(data)
+        write_sidecar(self.archive.sketch_file(hour), sketch.to_bytes())
+        write_sidecar(self.archive.top_file(hour), 
+                      json.dumps(heavy_hitters(data, self.top_n)).encode())
+        write_sidecar(self.archive.unresolved_file(hour), 
+                      json.dumps([ [dbname, title, v, error] for (dbname, title), v, error 
+                                  in (unresolved.top() if unresolved is not None else []) ]).encode())
+        # The manifest holds only the scalar columns of ``hours``
+        row = dict(file=filename, hour=hour, processed=utc_timestamp(),
+                   duration=int(time.time() - start_time), views=int(views.sum()),
+                   max_qid=int(qids[-1]) if len(qids) else 0, n_qids=len(qids),
+                   remapped=int(replace_hour), sketch=[sketch.width, sketch.depth])
+        with self._lock:
+            self.archive.append_row(row)
+        logging.getLogger(__name__).info(f"ArchiveWriter: hours row {row}")
@@ -0,0 +1,184 @@
+"""Compact columnar containers for log entries.
+
+Rather than holding one object per log line, entries are stored as a
+struct of arrays: project names are interned to small integers, titles
+are concatenated into one contiguous buffer with an array of offsets,
+and views are held in an integer array.  This costs about 10 bytes per
+entry on top of the title itself.
+
+Example::
+    batch = TitleBatch()
+    batch.append(b'Douglas_Adams', 42)
+    list(batch.titles())
+    # -> ['Douglas_Adams']
+"""
+
+from array import array
+
+
+class TitleColumns:
+    """Columnar (title, views) pairs, shared by ``TitleBatch`` and ``LogBatch``.
+
+    Titles are kept as undecoded bytes in ``buffer``; the i-th title is
+    ``buffer[offsets[i]:offsets[i+1]]`` and its views are ``views[i]``.
+
+    Lines that were filtered out before parsing are only counted, in
+    ``filtered_lines`` and ``filtered_views``.
+    """
+    __slots__ = ('buffer', 'offsets', 'views', 'filtered_lines', 'filtered_views')
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.offsets = array('I', [0])
+        self.views = array('I')
+        self.filtered_lines = 0
+        self.filtered_views = 0
+
+    def __len__(self):
+        return len(self.views)
+
+    def append(self, title:bytes, views:int):
+        """Add a single title and its view count"""
+        self.buffer += title
+        self.offsets.append(len(self.buffer))
+        self.views.append(views)
+
+    def title(self, i:int) -> bytes:
+        """Returns the i-th title as bytes"""
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i+1]])
+
+    def titles(self):
+        """Yields each title decoded as a string"""
+        buffer = bytes(self.buffer)
+        offsets = self.offsets
+        for i in range(len(self.views)):
+            yield buffer[offsets[i]:offsets[i+1]].decode()
+
+    def n_lines(self) -> int:
+        """Returns the number of log lines in the batch, including filtered lines"""
+        return len(self.views) + self.filtered_lines
+
+    def total_views(self) -> int:
+        """Returns the sum of views across the batch, including filtered lines"""
+        return sum(self.views) + self.filtered_views
+
+    def nbytes(self) -> int:
+        """Approximate memory used by the batch's buffers"""
+        return (len(self.buffer) + self.offsets.itemsize * len(self.offsets)
+                + self.views.itemsize * len(self.views))
+
+
+class TitleBatch(TitleColumns):
+    """Columnar batch of (title, views) pairs that can be combined with others."""
+    __slots__ = ()
+
+    def extend(self, other):
+        """Append the contents of another batch to this one"""
+        base = len(self.buffer)
+        self.buffer += other.buffer
+        self.offsets.extend(base + offset for offset in other.offsets[1:])
+        self.views.extend(other.views)
+        self.filtered_lines += other.filtered_lines
+        self.filtered_views += other.filtered_views
+
+    @classmethod
+    def concatenate(cls, batches):
+        """Combine several batches into a new one"""
+        result = cls()
+        for batch in batches:
+            result.extend(batch)
+        return result
+
+
+class LogBatch(TitleColumns):
+    """Columnar batch of log lines, each tagged with an interned project.
+
+    ``projects`` is the interning table (project name by id) and
+    ``project_ids[i]`` is the project of the i-th entry.  The table may
+    be shared between several batches read from the same file.
+    """
+    __slots__ = ('projects', 'project_ids')
+
+    def __init__(self, projects=None):
+        super().__init__()
+        self.projects = projects if projects is not None else []
+        self.project_ids = array('H')
+
+    def partition(self, key):
+        """Split the batch by a function of the project name.
+
+        Args:
+            key: Function that takes a project name and returns a partitioning key
+                (e.g. a database name or None)
+
+        Returns:
+            partitions: Dictionary from partitioning key to ``TitleBatch``;
+                the counts of filtered lines are carried by the batch under
+                the key None
+        """
+        results = dict()
+        targets = []
+        for project in self.projects:
+            k = key(project)
+            if k not in results:
+                results[k] = TitleBatch()
+            targets.append(results[k])
+        buffer = memoryview(self.buffer)
+        offsets = self.offsets
+        views = self.views
+        for i, project_id in enumerate(self.project_ids):
+            target = targets[project_id]
+            target.buffer += buffer[offsets[i]:offsets[i+1]]
+            target.offsets.append(len(target.buffer))
+            target.views.append(views[i])
+        buffer.release()
+        if self.filtered_lines:
+            filtered = results.setdefault(None, TitleBatch())
+            filtered.filtered_lines += self.filtered_lines
+            filtered.filtered_views += self.filtered_views
+        return { k: v for k, v in results.items() if v.n_lines() }
+
+
+class TitleIndex:
+    """Assigns dense integer ids to distinct titles.
+
+    Used to share a single set of titles (and hence a single round of
+    lookups) between several hours of log entries.  ``ids`` maps each title
+    to its id, and ``by_id`` lists the titles in id order.
+    """
+    __slots__ = ('ids', 'by_id')
+
+    def __init__(self):
+        self.ids = dict()
+        self.by_id = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, batch:TitleBatch) -> array:
+        """Intern each title in a batch
+
+        Args:
+            batch: ``TitleBatch`` of titles to add
+
+        Returns:
+            ids: Parallel array of title ids
+        """
+        ids = self.ids
+        by_id = self.by_id
+        results = array('I')
+        buffer = bytes(batch.buffer)
+        offsets = batch.offsets
+        for i in range(len(batch)):
+            title = buffer[offsets[i]:offsets[i+1]]
+            title_id = ids.get(title)
+            if title_id is None:
+                title_id = ids[title] = len(by_id)
+                by_id.append(title)
+            results.append(title_id)
+        return results
+
+    def titles(self):
+        """Yields each title decoded as a string, in id order"""
+        for title in self.by_id:
+            yield title.decode()
@@ -0,0 +1,122 @@
+"""Checkpoints to allow ``process_file`` to resume after being interrupted.
+
+Each log file gets its own directory under the work directory, holding:
+    * ``meta.json``: Identifies the input file and processing parameters
+    * ``chunk-NNNNNN.pickle``: Resolved QIDs for one chunk of titles, with a
+      key identifying the chunk's database and titles
+    * ``unresolved.pickle``: Sketch of the most viewed unresolved titles
+    * ``aggregate.pickle``: Final aggregated (qid, views) arrays for the file
+
+Example::
+    checkpoint = Checkpoint(work_dir, file, dict(chunk_size=10000))
+    qids = checkpoint.load_chunk(0, dbname, titles)
+    if qids is None:
+        checkpoint.save_chunk(0, dbname, titles, qids)
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+
+class Checkpoint:
+    """Work directory for a single log file.
+
+    Any existing checkpoints are discarded if the log file or the
+    processing parameters have changed since they were written.
+
+    Args:
+        work_dir: Base directory for checkpoints
+        file: Path to hourly log file
+        params: JSON-serializable dictionary of parameters that affect results
+    """
+    def __init__(self, work_dir, file, params=None):
+        self.path = Path(work_dir) / Path(file).name
+        stat = os.stat(file)
+        meta = dict(size=stat.st_size, mtime=stat.st_mtime, params=params or {})
+        meta_file = self.path / 'meta.json'
+        try:
+            with open(meta_file) as f:
+                existing = json.load(f)
+        except (OSError, ValueError):
+            existing = None
+        if existing != meta:
+            if existing is not None:
+                logging.getLogger(__name__).warning(f"Discarding stale checkpoints in {self.path}")
+            self.clear()
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._write(meta_file, lambda f: f.write(json.dumps(meta).encode()))
+
+    def _write(self, file, writer):
+        """Atomically write a file using a temporary file and rename"""
+        tmp = file.with_name(file.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            writer(f)
+        os.replace(tmp, file)
+
+    def _load(self, file):
+        """Returns unpickled contents of file, or None if it doesn't exist"""
+        try:
+            with open(file, 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _chunk_file(self, i):
+        return self.path / f"chunk-{i:06d}.pickle"
+
+    @staticmethod
+    def _chunk_key(dbname, titles):
+        """Identifies a chunk by its database, length, and a digest of its titles"""
+        digest = hashlib.sha256(titles.buffer)
+        digest.update(titles.offsets.tobytes())
+        return (dbname, len(titles), digest.hexdigest())
+
+    def load_chunk(self, i, dbname, titles):
+        """Returns the QIDs for chunk number ``i``, or None
+        
+        A saved chunk is only used if it was resolved from the same
+        database and titles, as chunk boundaries may differ between runs.
+
+        Args:
+            i: Chunk number
+            dbname: Database name of the chunk
+            titles: ``TitleBatch`` of the chunk's titles
+        """
+        saved = self._load(self._chunk_file(i))
+        if saved is None:
+            return None
+        key, qids = saved
+        if key != self._chunk_key(dbname, titles):
+            logging.getLogger(__name__).warning(f"Discarding mismatched checkpoint for chunk {i}")
+            return None
+        return qids
+
+    def save_chunk(self, i, dbname, titles, qids):
+        """Saves the QIDs for chunk number ``i``, resolved from ``titles`` of ``dbname``"""
+        key = self._chunk_key(dbname, titles)
+        self._write(self._chunk_file(i), lambda f: pickle.dump((key, qids), f))
+
+    def load_aggregate(self):
+        """Returns aggregated (qids, views) arrays for the file, or None"""
+        return self._load(self.path / 'aggregate.pickle')
+
+    def save_aggregate(self, qids, views):
+        """Saves aggregated (qids, views) arrays for the file"""
+        self._write(self.path / 'aggregate.pickle', lambda f: pickle.dump((qids, views), f))
+
+    def load_unresolved(self):
+        """Returns the sketch of unresolved titles for the file, or None"""
+        return self._load(self.path / 'unresolved.pickle')
+
+    def save_unresolved(self, sketch):
+        """Saves the sketch of unresolved titles for the file"""
+        self._write(self.path / 'unresolved.pickle', lambda f: pickle.dump(sketch, f))
+
+    def clear(self):
+        """Removes all checkpoints for this file"""
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -6,3 +6,12 @@ DEFAULT_DATABASE = 's53865__wdpv_p'
 DEFAULT_DIR = '/public/dumps/pageviews'
 DEFAULT_OUTPUT = Path.home() / 'www' / 'static' / 'latest.json'
 DEFAULT_DURATIONS = ['1d']
+DEFAULT_WORK_DIR = Path.home() / '.cache' / 'wdpv'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SHARD_SIZE = 16 * 1024 * 1024
+DEFAULT_TOP_N = 1000
+DEFAULT_UNRESOLVED_SIZE = 1000
+# Count-Min sketch overcounting bound, as a fraction of the views summed, which
+# for a typical hour of about 2e7 views is about 500 views (see ``sketch``)
+DEFAULT_SKETCH_EPSILON = 2.5e-5
+DEFAULT_SKETCH_DEPTH = 4
@@ -10,18 +10,44 @@ import argparse
 import sys
 import json
 import gzip
+import functools
+import hashlib
+import sqlite3
+import heapq
+import os
+from pathlib import Path
 
-import toolforge
+import numpy as np
 
 from .constants import *
+from .writer import connect
+from .archive import Archive, is_archive, archive_path
+from .sketch import SpaceSaving, CountMinSketch
 
 def datetime_as_mysql(dt):
-    """Converts datetime object into MySQL string format"""
+    """Converts datetime object into MySQL string format
+    
+    Strings (as returned by SQLite) are passed through unchanged.
+    """
+    if isinstance(dt, str):
+        return dt
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
+def open_source(database):
+    """Open a database cursor or, for names like ``archive:DIR``, an ``Archive``
+    
+    Either can be passed as ``cursor`` to the functions below.
+    """
+    if is_archive(database):
+        return Archive(archive_path(database))
+    return connect(database)
+
+
 def latest_available_hour(cursor):
     """Returns the last available hour in the database"""
+    if isinstance(cursor, Archive):
+        return cursor.latest_hour()
     sql = dedent(f"""
         SELECT MAX(hour) FROM hours;
     """)
@@ -42,7 +68,7 @@ def parse_hour(hour):
     """
     m = HOUR_RE.search(hour)
     if m:
-        return f"$1 $2:00:00"
+        return f"{m.group(1)} {m.group(2)}:00:00"
     logging.getLogger(__name__).info(f"parse_hour: Could not parse: {hour}")
     return None
 
@@ -123,6 +149,8 @@ def get_hours(cursor, start, end):
     Returns:
         hours: List of hours like "2018-10-10 01:00:00"
     """
+    if isinstance(cursor, Archive):
+        return cursor.hours(start, end)
     sql = dedent(f"""
         SELECT hour FROM hours
         WHERE hour >= '{start}' AND hour <= '{end}';
@@ -132,6 +160,32 @@ def get_hours(cursor, start, end):
     return [ datetime_as_mysql(hour) for (hour,) in cursor.fetchall() ]
 
 
+def get_hour_revisions(cursor, start, end):
+    """Report when each hour in range was last written
+    
+    Rewriting an hour (e.g. with ``wdpv-remap``) changes its ``processed``
+    time, and usually its totals, without changing the set of hours.
+    
+    Args:
+        cursor: Database cursor
+        start: Hour like "2018-10-10 01:00:00"
+        end: Hour like "2018-10-10 01:00:00"
+        
+    Returns:
+        revisions: Sorted list of (hour, processed, views, n_qids)
+    """
+    if isinstance(cursor, Archive):
+        return cursor.revisions(start, end)
+    sql = dedent(f"""
+        SELECT hour, processed, views, n_qids FROM hours
+        WHERE hour >= '{start}' AND hour <= '{end}';
+    """)
+    logging.getLogger(__name__).debug(sql)
+    cursor.execute(sql)
+    return sorted((datetime_as_mysql(hour), datetime_as_mysql(processed), int(views), int(n_qids))
+                  for hour, processed, views, n_qids in cursor.fetchall())
+
+
 def aggregate_by_qid(cursor, start, end):
     """The main work of getting the qid/views pairs
     
@@ -143,11 +197,16 @@ def aggregate_by_qid(cursor, start, end):
         qid: Integer like 42 for "Q42"
         views: Number of page views
     """
+    if isinstance(cursor, Archive):
+        qids, views = cursor.aggregate(start, end)
+        nonzero = qids != 0
+        yield from zip(qids[nonzero].tolist(), views[nonzero].tolist())
+        return
     sql = dedent(f"""
         SELECT qid, SUM(views) AS views 
         FROM qid_hourly_views 
-        WHERE hour >= "{start}"
-        AND hour <= "{end}"
+        WHERE hour >= '{start}'
+        AND hour <= '{end}'
         GROUP BY qid;
     """)
     logging.getLogger(__name__).debug(sql)
@@ -170,12 +229,14 @@ def get_summary(cursor, start, end):
         max_qid: Maximum QID seen in any hour
         views: Total views across all hours
     """
+    if isinstance(cursor, Archive):
+        return cursor.summary(start, end)
     sql = dedent(f"""
         SELECT MAX(max_qid) AS max_qid,
             SUM(views) AS views
         FROM hours
-        WHERE hour >= "{start}"
-        AND hour <= "{end}";
+        WHERE hour >= '{start}'
+        AND hour <= '{end}';
     """)
     logging.getLogger(__name__).debug(sql)
     cursor.execute(sql)
@@ -183,34 +244,492 @@ def get_summary(cursor, start, end):
     return (int(max_qid), float(views))
 
         
-def get_dump(database=DEFAULT_DATABASE, start=None, end=None, mode=None):
+def aggregate_arrays(cursor, start, end):
+    """As ``aggregate_by_qid``, but returning parallel arrays
+    
+    Returns:
+        qids: Array of QIDs
+        views: Parallel array of views
+    """
+    if isinstance(cursor, Archive):
+        qids, views = cursor.aggregate(start, end)
+        nonzero = qids != 0
+        return (qids[nonzero], views[nonzero])
+    return pairs_as_arrays(aggregate_by_qid(cursor, start, end))
+
+
+def pairs_as_arrays(pairs):
+    """Convert (qid, views) pairs into parallel int64 arrays"""
+    pairs = list(pairs)
+    qids = np.fromiter((qid for qid, _ in pairs), dtype=np.int64, count=len(pairs))
+    views = np.fromiter((views for _, views in pairs), dtype=np.int64, count=len(pairs))
+    return (qids, views)
+
+
+def compute_logprobs(views, max_qid, total_views, smoothing=1.0):
+    """Estimate log probabilities with additive smoothing
+    
+    Every QID up to ``max_qid`` is treated as having received ``smoothing``
+    extra views, so that unseen QIDs get a finite ``default_logprob``.
+    As ``total_views`` includes views that could not be converted, probabilities
+    are relative to all page views, not just those with a QID.
+    
+    Args:
+        views: Array of views
+        max_qid: Maximum QID, as from ``get_summary``
+        total_views: Total views, as from ``get_summary``
+        smoothing: Pseudo-count added to each QID, which must be positive
+        
+    Returns:
+        logprobs: Parallel array of natural log probabilities
+        default_logprob: Log probability for QIDs with no views
+    """
+    # Without smoothing, unseen QIDs would get -inf, which is not valid JSON
+    assert smoothing > 0, f"smoothing must be positive: {smoothing}"
+    log_denominator = np.log(total_views + smoothing * (max_qid + 1))
+    logprobs = np.log(np.asarray(views, dtype=np.float64) + smoothing) - log_denominator
+    default_logprob = float(np.log(smoothing) - log_denominator)
+    return (logprobs, default_logprob)
+
+
+LOGPROB_DTYPES = ['float64', 'float32', 'float16', 'int16']
+
+def compact_logprobs(logprobs, default_logprob, dtype='float32'):
+    """Convert log probabilities into a compact type
+    
+    For ``int16``, values are quantized linearly over the range from
+    ``default_logprob`` to zero; multiply by ``scale`` to recover them.
+    
+    Returns:
+        values: Array of type ``dtype``
+        scale: Multiplier to convert values back into log probabilities, or None
+    """
+    if dtype != 'int16':
+        return (logprobs.astype(dtype), None)
+    scale = min(default_logprob, logprobs.min(initial=0)) / -32767
+    if scale == 0 or not np.isfinite(scale):
+        scale = 1.0
+    return (np.round(logprobs / scale).astype(np.int16), scale)
+
+
+def top_by_qid(cursor, start, end, n):
+    """Find the most viewed QIDs without materializing every QID
+    
+    For an archive, selection is by partial sort of the aggregated arrays;
+    for a database, the server keeps only the top rows while sorting.
+    
+    Args:
+        cursor: Database cursor
+        start: Hour like "2018-10-10 01:00:00"
+        end: Hour like "2018-10-10 01:00:00"
+        n: Number of QIDs to return
+    Returns:
+        qids: Array of QIDs, in descending order of views
+        views: Parallel array of views
+    """
+    if isinstance(cursor, Archive):
+        qids, views = aggregate_arrays(cursor, start, end)
+        if len(qids) > n:
+            selected = np.argpartition(-views, n - 1)[:n]
+            qids, views = qids[selected], views[selected]
+        order = np.lexsort((qids, -views))
+        return (qids[order], views[order])
+    sql = dedent(f"""
+        SELECT qid, SUM(views) AS views 
+        FROM qid_hourly_views 
+        WHERE hour >= '{start}'
+        AND hour <= '{end}'
+        AND qid != 0
+        GROUP BY qid
+        ORDER BY views DESC, qid
+        LIMIT {int(n)};
+    """)
+    logging.getLogger(__name__).debug(sql)
+    cursor.execute(sql)
+    return pairs_as_arrays((qid, int(views)) for qid, views in cursor)
+
+
+def approximate_top_by_qid(cursor, start, end, n):
+    """Estimate the most viewed QIDs from the heavy hitters kept for each hour
+    
+    Only the ``hourly_top`` lists recorded during ingestion are read, so this is
+    cheap even for long windows.  Each estimate is a lower bound: a QID's views
+    are missed for any hour in which it was not among that hour's heavy hitters,
+    and so by at most the smallest listed views of each such hour.  QIDs that are
+    never a heavy hitter may be missing altogether.
+    
+    Returns:
+        qids: Array of QIDs, in descending order of estimated views
+        views: Parallel array of estimated views
+    """
+    if isinstance(cursor, Archive):
+        totals = dict()
+        for _, qid, views in cursor.heavy_hitters(start, end):
+            totals[qid] = totals.get(qid, 0) + views
+        return pairs_as_arrays(heapq.nsmallest(n, totals.items(), key=lambda x: (-x[1], x[0])))
+    sql = dedent(f"""
+        SELECT qid, SUM(views) AS views 
+        FROM hourly_top 
+        WHERE hour >= '{start}'
+        AND hour <= '{end}'
+        GROUP BY qid
+        ORDER BY views DESC, qid
+        LIMIT {int(n)};
+    """)
+    logging.getLogger(__name__).debug(sql)
+    cursor.execute(sql)
+    return pairs_as_arrays((qid, int(views)) for qid, views in cursor)
+
+
+def merge_unresolved(cursor, start, end):
+    """Merge the sketches of unresolved titles kept for each hour
+    
+    Args:
+        cursor: Database cursor
+        start: Hour like "2018-10-10 01:00:00"
+        end: Hour like "2018-10-10 01:00:00"
+    Returns:
+        sketch: ``SpaceSaving`` keyed by (dbname, title)
+    """
+    if isinstance(cursor, Archive):
+        rows = cursor.unresolved(start, end)
+    else:
+        sql = dedent(f"""
+            SELECT hour, dbname, title, views, error
+            FROM hourly_unresolved
+            WHERE hour >= '{start}'
+            AND hour <= '{end}';
+        """)
+        logging.getLogger(__name__).debug(sql)
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+    by_hour = dict()
+    for hour, dbname, title, views, error in rows:
+        if isinstance(title, bytes): # Binary columns in the database
+            dbname, title = dbname.decode(), title.decode()
+        by_hour.setdefault(hour, []).append(((dbname, title), int(views), int(error)))
+    # Each hour kept every title of a sketch of this capacity, so an hour
+    # with fewer titles never evicted any, and is exact
+    hours = ( SpaceSaving.from_items(items, DEFAULT_UNRESOLVED_SIZE) for items in by_hour.values() )
+    return functools.reduce(SpaceSaving.merge, hours, SpaceSaving(1))
+
+
+def sketch_periods(start, end, months=True):
+    """Split a range of hours into whole months, whole days, and the hours left over
+    
+    Args:
+        start: Hour like "2018-10-10 01:00:00"
+        end: Hour like "2018-10-10 01:00:00"
+        months: Whether to use whole months, or only days
+    Returns:
+        periods: List of (period, start, end) in order, where period is like
+            "2018-10" for a month, "2018-10-10" for a day, or None for hours within a day
+    """
+    hour = datetime.timedelta(hours=1)
+    t = datetime.datetime.strptime(start, "%Y-%m-%d %H:%M:%S")
+    last = datetime.datetime.strptime(end, "%Y-%m-%d %H:%M:%S")
+    periods = []
+    while t <= last:
+        next_day = t.replace(hour=0) + datetime.timedelta(days=1)
+        next_month = (t.replace(day=1, hour=0) + datetime.timedelta(days=32)).replace(day=1)
+        if months and t.day == 1 and t.hour == 0 and next_month - hour <= last:
+            period, stop = t.strftime('%Y-%m'), next_month
+        elif t.hour == 0 and next_day - hour <= last:
+            period, stop = t.strftime('%Y-%m-%d'), next_day
+        else:
+            period, stop = None, min(next_day, last + hour)
+        periods.append((period, datetime_as_mysql(t), datetime_as_mysql(stop - hour)))
+        t = stop
+    return periods
+
+
+def hour_sketches(cursor, start, end):
+    """Yields the Count-Min sketch kept for each hour in the range"""
+    if isinstance(cursor, Archive):
+        yield from cursor.sketches(start, end)
+        return
+    sql = dedent(f"""
+        SELECT width, depth, counts
+        FROM hourly_sketch
+        WHERE hour >= '{start}'
+        AND hour <= '{end}';
+    """)
+    logging.getLogger(__name__).debug(sql)
+    cursor.execute(sql)
+    for width, depth, counts in cursor.fetchall():
+        yield CountMinSketch.from_bytes(counts, width, depth)
+
+
+def load_rollup(cursor, period):
+    """Returns the (revision, ``CountMinSketch``) saved for a day or month, or None"""
+    if isinstance(cursor, Archive):
+        return cursor.rollup(period)
+    cursor.execute(f"SELECT revision, width, depth, counts FROM sketch_rollup "
+                   f"WHERE period = '{period}'")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    revision, width, depth, counts = row
+    return (bytes(revision), CountMinSketch.from_bytes(counts, width, depth))
+
+
+def save_rollup(cursor, period, revision, sketch):
+    """Save the merged sketch of a day or month, as of a revision of its hours"""
+    if isinstance(cursor, Archive):
+        return cursor.save_rollup(period, revision, sketch)
+    sql = dedent("""
+        REPLACE INTO sketch_rollup (period, revision, width, depth, counts)
+        VALUES (%s, %s, %s, %s, %s)
+    """).strip()
+    if isinstance(cursor, sqlite3.Cursor):
+        sql = sql.replace('%s', '?')
+    cursor.execute(sql, (period, revision, sketch.width, sketch.depth, sketch.to_bytes()))
+
+
+def rollup_revision(revisions):
+    """Digest of the hours in a period and when each was last written"""
+    return hashlib.sha256(json.dumps(revisions).encode()).digest()
+
+
+def merge_all(sketches):
+    """Merge an iterable of ``CountMinSketch``, returning None if it is empty"""
+    return functools.reduce(lambda a, b: b if a is None else a.merge(b), sketches, None)
+
+
+def merge_sketches(cursor, start, end, revisions=None, months=True):
+    """Merge the Count-Min sketches kept for each hour
+    
+    Whole days and months in the range are read from rollups, so that 30 days
+    cost about 30 sketches rather than 720.  A rollup is built (a month from
+    its days) and saved when first needed, and rebuilt whenever any of its
+    hours has since been added or rewritten.
+    
+    Args:
+        cursor: Database cursor
+        start: Hour like "2018-10-10 01:00:00"
+        end: Hour like "2018-10-10 01:00:00"
+        revisions: Hour revisions in the range, as from ``get_hour_revisions``
+        months: Whether to use monthly rollups
+    Returns:
+        sketch: ``CountMinSketch`` of views over the range, or None if there are none
+    """
+    logger = logging.getLogger(__name__)
+    if revisions is None:
+        revisions = get_hour_revisions(cursor, start, end)
+
+    def sketches():
+        for period, period_start, period_end in sketch_periods(start, end, months):
+            if period is None:
+                yield from hour_sketches(cursor, period_start, period_end)
+                continue
+            period_revisions = [ r for r in revisions if period_start <= r[0] <= period_end ]
+            if not period_revisions:
+                continue
+            revision = rollup_revision(period_revisions)
+            rollup = load_rollup(cursor, period)
+            if rollup is not None and rollup[0] == revision:
+                yield rollup[1]
+                continue
+            logger.info(f"Building sketch rollup for {period}")
+            if len(period) == len('2018-10'):
+                sketch = merge_sketches(cursor, period_start, period_end, period_revisions,
+                                        months=False)
+            else:
+                sketch = merge_all(hour_sketches(cursor, period_start, period_end))
+            if sketch is not None:
+                save_rollup(cursor, period, revision, sketch)
+                yield sketch
+
+    return merge_all(sketches())
+
+
+def heavy_hitter_qids(cursor, start, end):
+    """Returns sorted array of QIDs that were heavy hitters in any hour in the range"""
+    if isinstance(cursor, Archive):
+        qids = { qid for _, qid, _ in cursor.heavy_hitters(start, end) }
+    else:
+        sql = dedent(f"""
+            SELECT DISTINCT qid
+            FROM hourly_top
+            WHERE hour >= '{start}'
+            AND hour <= '{end}';
+        """)
+        logging.getLogger(__name__).debug(sql)
+        cursor.execute(sql)
+        qids = { qid for (qid,) in cursor.fetchall() }
+    return np.array(sorted(qids), dtype=np.int64)
+
+
+def sketch_estimates(cursor, start, end, qids=None):
+    """Estimate views from the Count-Min sketches kept for each hour
+    
+    Args:
+        cursor: Database cursor
+        start: Hour like "2018-10-10 01:00:00"
+        end: Hour like "2018-10-10 01:00:00"
+        qids: QIDs to estimate; by default, those that were heavy hitters in any hour
+            (see ``approximate_top_by_qid``), so that the result estimates the top QIDs
+    Returns:
+        qids: Array of QIDs, in descending order of estimated views
+        views: Parallel array of estimated views
+        sketch: Merged ``CountMinSketch``, or None if no hours have sketches
+    """
+    sketch = merge_sketches(cursor, start, end)
+    if qids is None:
+        qids = heavy_hitter_qids(cursor, start, end)
+    qids = np.asarray(qids, dtype=np.int64)
+    if sketch is None:
+        return (qids, np.zeros(len(qids), dtype=np.int64), None)
+    views = sketch.estimate(qids).astype(np.int64)
+    order = np.lexsort((qids, -views))
+    return (qids[order], views[order], sketch)
+
+
+def window_summary(cursor, start, end):
+    """Resolve a window and describe it
+    
+    Args:
+        cursor: Database cursor
+        start: Start as for ``convert_start_and_end``
+        end: End as for ``convert_start_and_end``
+
+    Returns:
+        summary: Dictionary of summary information, including the converted ``start`` and ``end``
+    """
+    logger = logging.getLogger(__name__)
+    (start, end) = convert_start_and_end(cursor, start, end)    
+    logger.info(f"start={start}, end={end}")
+    hours = get_hours(cursor, start, end)
+    logger.info(f"{len(hours)} hours")
+    (max_qid, total_views) = get_summary(cursor, start, end)
+    return dict(
+        start=start,
+        end=end,
+        hours=hours,
+        max_qid=max_qid,
+        total_views=total_views,
+    )
+
+
+def get_top_arrays(database=DEFAULT_DATABASE, start=None, end=None, n=100, approximate=False):
+    """As ``get_top``, but returning data as arrays
+    
+    Returns:
+        summary: Dictionary of summary information
+        qids: Array of QIDs, in descending order of views
+        views: Parallel array of views
+    """
+    with open_source(database) as cursor:
+        summary = window_summary(cursor, start, end)
+        select = approximate_top_by_qid if approximate else top_by_qid
+        qids, views = select(cursor, summary['start'], summary['end'], n)
+    summary.update(top=n, approximate=approximate)
+    return (summary, qids, views)
+
+
+def get_top(database=DEFAULT_DATABASE, start=None, end=None, n=100, approximate=False):
+    """Returns the most viewed QIDs in a window
+    
+    Args:
+        database: name of database to use, or ``archive:DIR`` for a columnar archive
+        start: Start hour as "2018-10-10T01" or a duration like "1d"
+        end: End hour as "2018-10-10T01" or None
+        n: Number of QIDs to return
+        approximate: Estimate from the heavy hitters kept for each hour
+            (see ``approximate_top_by_qid``) rather than scanning every row
+
+    Returns:
+        summary: Dictionary of summary information
+        data: List of (qid, views) pairs, in descending order of views
+    """
+    summary, qids, views = get_top_arrays(database, start, end, n, approximate)
+    return (summary, list(zip(qids.tolist(), views.tolist())))
+
+
+def get_unresolved(database=DEFAULT_DATABASE, start=None, end=None, n=100):
+    """Returns the most viewed titles that could not be converted to QIDs
+    
+    Counts come from merging the bounded sketches kept for each hour, so they
+    are upper bounds, and ``views - error`` is a lower bound.
+    
+    Args:
+        database: name of database to use, or ``archive:DIR`` for a columnar archive
+        start: Start hour as "2018-10-10T01" or a duration like "1d"
+        end: End hour as "2018-10-10T01" or None
+        n: Number of titles to return
+
+    Returns:
+        summary: Dictionary of summary information
+        data: List of (dbname, title, views, error) tuples, in descending order of views
+    """
+    with open_source(database) as cursor:
+        summary = window_summary(cursor, start, end)
+        sketch = merge_unresolved(cursor, summary['start'], summary['end'])
+    return (summary, [ (dbname, title, views, error) 
+                      for (dbname, title), views, error in sketch.top(n) ])
+
+
+def get_dump_arrays(database=DEFAULT_DATABASE, start=None, end=None, mode=None,
+                    smoothing=1.0, dtype='float32', qids=None):
+    """As ``get_dump``, but returning data as arrays
+    
+    Returns:
+        summary: Dictionary of summary information
+        qids: Array of QIDs
+        values: Parallel array of views or (in ``logprobs`` mode) log probabilities
+    """
+    with open_source(database) as cursor:
+        summary = window_summary(cursor, start, end)
+        if mode == 'sketch':
+            qids, values, sketch = sketch_estimates(cursor, summary['start'], summary['end'], qids)
+        else:
+            qids, values = aggregate_arrays(cursor, summary['start'], summary['end'])
+    if mode == 'sketch':
+        if sketch is not None:
+            summary.update(epsilon=sketch.epsilon, delta=sketch.delta,
+                           error_bound=sketch.epsilon * summary['total_views'])
+    elif mode == 'logprobs':
+        max_qid, total_views = summary['max_qid'], summary['total_views']
+        logprobs, default_logprob = compute_logprobs(values, max_qid, total_views, smoothing)
+        values, scale = compact_logprobs(logprobs, default_logprob, dtype)
+        summary.update(default_logprob=default_logprob, smoothing=smoothing, 
+                       dtype=dtype, scale=scale)
+    else:
+        assert mode in [None, 'views'], f"Unknown mode {mode}"
+    return (summary, qids, values)
+
+        
+def get_dump(database=DEFAULT_DATABASE, start=None, end=None, mode=None, 
+             smoothing=1.0, dtype='float32', qids=None):
     """Returns result object for bulk aggregation
     
     Args:
-        database: name of database to use
+        database: name of database to use, or ``archive:DIR`` for a columnar archive
         start: Start hour as "2018-10-10T01" or a duration like "1d"
         end: End hour as "2018-10-10T01" or None
         mode: How to manipulate results
             views: (default) Report raw views in ``views`` field
             logprobs: Estimate log probabilities in ``logprobs`` and ``default_logprob`` field
+            sketch: Estimate views of ``qids`` (or of the likely top QIDs) from the
+                per-hour Count-Min sketches, in descending order, without scanning rows.
+                Estimates never undercount, and with probability at least 1 - ``delta``
+                each overcounts by at most ``error_bound`` (``epsilon`` times ``total_views``),
+                all given in the summary.
+        smoothing: Pseudo-count of views added to every QID in ``logprobs`` mode
+        dtype: Type of log probabilities (one of ``LOGPROB_DTYPES``) in ``logprobs`` mode;
+            for ``int16``, the summary gives the ``scale`` to multiply by
+        qids: QIDs to estimate in ``sketch`` mode
     """
-    logger = logging.getLogger(__name__)
-    with toolforge.connect(database, cluster="tools") as cursor:
-        (start, end) = convert_start_and_end(cursor, start, end)    
-        logger.info(f"start={start}, end={end}")
-        hours = get_hours(cursor, start, end)
-        logger.info(f"{len(hours)} hours")
-        (max_qid, total_views) = get_summary(cursor, start, end)
-        summary = dict(
-            start=start,
-            end=end,
-            hours=hours,
-            max_qid=max_qid,
-            total_views=total_views,
-        )
-        data = list(aggregate_by_qid(cursor, start, end))
-            
-        return (summary, data)
+    summary, qids, values = get_dump_arrays(database, start, end, mode, smoothing, dtype, qids)
+    return (summary, list(zip(qids.tolist(), values.tolist())))
+
+
+def write_npz(output, summary, qids, values):
+    """Write typed arrays and JSON summary to a compressed ``.npz`` file"""
+    with open(output, 'wb') as f:
+        np.savez_compressed(f, summary=np.array(json.dumps(summary)),
+                            qids=qids.astype(np.uint32), values=values)
+
     
 def parse_args(argv=None):
     """Wrapper for argparse.ArgumentParser()"""
@@ -224,9 +743,35 @@ def parse_args(argv=None):
     parser.add_argument('--database', '--db', help='database name', default=DEFAULT_DATABASE)
     parser.add_argument('--start', help='Start time, e.g. 2018-10-10T17 or 1d')
     parser.add_argument('--end', help="End time, e.g. 2018-10-10T17")
-    parser.add_argument('--mode', help="Mode, e.g. views, logprobs")
+    parser.add_argument('--mode', help="Mode, e.g. views, logprobs, sketch")
+    parser.add_argument('--smoothing', type=float, default=1.0,
+                        help="Pseudo-count (positive) added to each QID in logprobs mode")
+    parser.add_argument('--dtype', choices=LOGPROB_DTYPES, default='float32',
+                        help="Type of log probabilities in logprobs mode")
+    parser.add_argument('--qids', type=lambda s: [ int(qid.lstrip('Qq')) for qid in s.split(',') ],
+                        help="Comma-separated QIDs to estimate in sketch mode")
+    parser.add_argument('--top', type=int, metavar='N',
+                        help="Only report the N most viewed QIDs, in descending order")
+    parser.add_argument('--approximate', action='store_true',
+                        help="With --top, estimate from the heavy hitters kept for each hour")
+    parser.add_argument('--unresolved', type=int, metavar='N',
+                        help="Report the N most viewed titles that could not be converted")
+    parser.add_argument('-o', '--output', type=Path, 
+                        help="Compressed file to write to, only if new hours have arrived "
+                        "(default standard output); use a .npz suffix for typed arrays")
     logger = logging.getLogger(__name__)
     args = parser.parse_args(argv)
+    if args.top is not None and args.mode not in [None, 'views', 'sketch']:
+        parser.error("--top only reports views")
+    if args.approximate and (args.top is None or args.mode == 'sketch'):
+        parser.error("--approximate requires --top, and is not used in sketch mode")
+    if not args.smoothing > 0:
+        parser.error("--smoothing must be positive")
+    if args.qids is not None and args.mode != 'sketch':
+        parser.error("--qids requires --mode sketch")
+    if args.unresolved is not None and (args.top is not None or args.mode not in [None, 'views']
+                                        or (args.output is not None and args.output.suffix == '.npz')):
+        parser.error("--unresolved cannot be combined with --top, --mode or typed output")
     log_level = logging.DEBUG if args.debug else logging.INFO if args.verbose else logging.WARNING
     logging.basicConfig()
     logger.setLevel(log_level)
@@ -235,33 +780,157 @@ def parse_args(argv=None):
     return args
 
 
-def main():
+def dump_key(database, windows, mode=None, **options):
+    """Compute a validity key for a dump without aggregating
+    
+    The key changes whenever the requested windows, the mode, or the set of 
+    hours available within any window changes, or when any of those hours
+    is rewritten.
+    
+    Args:
+        database: name of database to use
+        windows: List of (start, end) pairs as for ``get_dump``
+        mode: Mode as for ``get_dump``
+        **options: Other options that affect the result
+        
+    Returns:
+        key: Hex string
+    """
+    with open_source(database) as cursor:
+        resolved = []
+        for start, end in windows:
+            (start_converted, end_converted) = convert_start_and_end(cursor, start, end)
+            hours = get_hour_revisions(cursor, start_converted, end_converted)
+            resolved.append(dict(start=start, end=end, 
+                                 start_converted=start_converted, end_converted=end_converted,
+                                 hours=hours))
+    description = json.dumps(dict(windows=resolved, mode=mode, **options), sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def key_file(output):
+    """Path of the sidecar file holding the validity key for an output file
+    
+    Web servers can use its contents as an ETag.
+    """
+    return output.with_name(output.name + '.etag')
+
+
+def write_json(output, result):
+    """Write result to a compressed JSON file"""
+    with gzip.open(output, 'wt') as f:
+        json.dump(result, f)
+
+
+def write_if_changed(output, key, make_result, write=write_json):
+    """Write a file only if its validity key has changed
+    
+    Args:
+        output: Path to write to
+        key: Validity key from ``dump_key``
+        make_result: Function returning a result
+        write: Function taking a path and a result, by default writing compressed JSON
+        
+    Returns:
+        written: True if the file was (re)written
+    """
+    logger = logging.getLogger(__name__)
+    output = Path(output)
+    try:
+        if output.exists() and key_file(output).read_text().strip() == key:
+            logger.info(f"{output} is up to date ({key})")
+            return False
+    except FileNotFoundError:
+        pass
+    result = make_result()
+    tmp = output.with_name(output.name + '.tmp')
+    write(tmp, result)
+    os.replace(tmp, output)
+    key_file(output).write_text(key + "\n")
+    logger.info(f"Wrote {output} ({key})")
+    return True
+
+
+def main(argv=None):
     """Operate from a command-line"""
-    args = parse_args()
-    summary, data = get_dump(database=args.database, 
-                             start=args.start,
-                             end=args.end,
-                             mode=args.mode,
-                            )
-    result = summary
-    result['views'] = { "Q" + str(qid):views for qid, views in data }
-    json.dump(result, sys.stdout)
-
-def write_combination_file(output, durations=DEFAULT_DURATIONS, database=DEFAULT_DATABASE):
+    args = parse_args(argv)
+    
+    typed = args.output is not None and args.output.suffix == '.npz'
+    
+    def make_result():
+        if args.unresolved is not None:
+            summary, data = get_unresolved(database=args.database, start=args.start,
+                                           end=args.end, n=args.unresolved)
+            summary['unresolved'] = data
+            return summary
+        if args.top is not None and args.mode != 'sketch':
+            summary, qids, values = get_top_arrays(database=args.database,
+                                                   start=args.start,
+                                                   end=args.end,
+                                                   n=args.top,
+                                                   approximate=args.approximate,
+                                                  )
+        else:
+            summary, qids, values = get_dump_arrays(database=args.database, 
+                                                    start=args.start,
+                                                    end=args.end,
+                                                    mode=args.mode,
+                                                    smoothing=args.smoothing,
+                                                    dtype=args.dtype,
+                                                    qids=args.qids,
+                                                   )
+            if args.top is not None:
+                qids, values = qids[:args.top], values[:args.top]
+                summary['top'] = args.top
+        if typed:
+            return (summary, qids, values)
+        result = summary
+        field = 'logprobs' if args.mode == 'logprobs' else 'views'
+        result[field] = { "Q" + str(qid):value 
+                         for qid, value in zip(qids.tolist(), values.tolist()) }
+        return result
+    
+    if args.output is None:
+        json.dump(make_result(), sys.stdout)
+    else:
+        key = dump_key(args.database, [(args.start, args.end)], args.mode,
+                       smoothing=args.smoothing, dtype=args.dtype, typed=typed,
+                       top=args.top, approximate=args.approximate, unresolved=args.unresolved,
+                       qids=args.qids)
+        write_if_changed(args.output, key, make_result, 
+                         write=(lambda f, r: write_npz(f, *r)) if typed else write_json)
+
+def write_combination_file(output, durations=DEFAULT_DURATIONS, database=DEFAULT_DATABASE,
+                           mode=None):
     """Writes out a single JSON file (compressed)
     
+    The file is only rewritten if the hours in any of the durations have
+    been added or rewritten since it was last written, as recorded in a 
+    sidecar file.
+    
     Args:
         output: Path to write to
         durations: List of duration strings
         database: Database to use for report
+        mode: Mode as for ``get_dump``
+        
+    Returns:
+        written: True if the file was (re)written
     """
-    parts = [ get_dump(database=database, start=duration) for duration in durations ]
-    aggregations = [ summary for summary, data in parts]
-    qids = set.intersection(data.keys() for summary, data in parts)
-    views = {
-        "Q" + str(qid): [ part['views'].get(qid, 0) for part in parts ]
-        for qid in qids
-    }
-    result = dict(aggregations=aggregations, views=views)
-    with gzip.open(output, 'wb') as f:
-        json.dump(result, f)
+    def make_result():
+        parts = [ get_dump(database=database, start=duration, mode=mode) 
+                 for duration in durations ]
+        aggregations = [ summary for summary, data in parts]
+        part_views = [ dict(data) for summary, data in parts ]
+        # QIDs missing from a part have no views, or its smoothed log probability
+        defaults = [ summary.get('default_logprob', 0) for summary in aggregations ]
+        qids = set().union(*part_views)
+        views = {
+            "Q" + str(qid): [ views.get(qid, default) 
+                             for views, default in zip(part_views, defaults) ]
+            for qid in qids
+        }
+        return dict(aggregations=aggregations, views=views)
+    
+    key = dump_key(database, [ (duration, None) for duration in durations ], mode)
+    return write_if_changed(output, key, make_result)
@@ -1,12 +1,20 @@
 """Utilities for dealing with the jobs on the grid"""
 
-from typing import Iterable, NamedTuple
+from typing import Iterable, NamedTuple, Optional
 import subprocess
 import xml.etree.ElementTree as ET
 import time
 import sys
 import argparse
-import requests
+import datetime
+from pathlib import Path
+from textwrap import dedent
+
+from .constants import *
+from .writer import connect
+from .process_log import get_files, file_hour
+
+QSTAT = '/usr/bin/qstat'
 
 class Job(NamedTuple):
     num: int
@@ -15,44 +23,175 @@ class Job(NamedTuple):
     long_state: str
 
 
-def job_status() -> Iterable[Job]:
+def job_status(qstat=QSTAT) -> Iterable[Job]:
     """Check jobs on queue and yields job objects
+    
+    The XML output is parsed incrementally as it is read.
+
+    Args:
+        qstat: Path to ``qstat`` executable
 
     Yields:
         job: Job object
     """
-    cmd = [ '/usr/bin/qstat', '-xml' ]
-    try:
-        xml = subprocess.check_output(cmd, shell=False)
-    except subprocess.CalledProcessError as e:
-        print("Output:", e.output)
-        print("Error:", e.stderr)
-        raise
-    tree = ET.fromstring(xml)
-    for job in tree.iter('job_list'):
-        long_state = job.attrib['state']
-        num = job.find('JB_job_number').text
-        name = job.find('JB_name').text
-        state = job.find('state').text
-        j = Job(num, name, state, long_state)
-        yield(j)
-
-
-def monitor_jobs(sleep_secs=60):
-    """Continuously monitor jobs, yielding changes""" 
+    cmd = [ qstat, '-xml' ]
+    with subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE) as proc:
+        for _, job in ET.iterparse(proc.stdout):
+            if job.tag != 'job_list':
+                continue
+            long_state = job.attrib['state']
+            num = job.find('JB_job_number').text
+            name = job.find('JB_name').text
+            state = job.find('state').text
+            j = Job(num, name, state, long_state)
+            job.clear()
+            yield(j)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+class IngestionStatus(NamedTuple):
+    latest_file_hour: Optional[datetime.datetime]
+    latest_db_hour: Optional[datetime.datetime]
+    lag_hours: Optional[float]
+    hours_per_hour: int
+    avg_duration: Optional[float]
+    remapped_per_hour: int
+    file_age_hours: Optional[float]
+
+
+def _as_datetime(hour):
+    """Convert database or filename hour into datetime (or None)"""
+    if hour is None or isinstance(hour, datetime.datetime):
+        return hour
+    return datetime.datetime.fromisoformat(str(hour))
+
+
+def ingestion_status(database=DEFAULT_DATABASE, dir=DEFAULT_DIR, now=None) -> IngestionStatus:
+    """Report how well processing is keeping up with the pageview files
+    
+    All times are in UTC: the files are named by UTC hour, and the writers
+    record ``processed`` in UTC.  Hours rewritten by ``wdpv-remap`` are
+    counted separately, so that a remap does not look like ingestion.
+    
+    Args:
+        database: Name of database (or ``sqlite:PATH``)
+        dir: Directory of pageview files
+        now: Current UTC time (for testing)
+        
+    Returns:
+        status: ``IngestionStatus`` giving the newest file and newest processed hour,
+            the lag between them, the number of hours ingested in the last hour
+            and their average duration in seconds, the number of hours remapped
+            in the last hour, and the age of the newest file in hours
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    files = get_files(Path(dir), 2, now)
+    latest_file_hour = _as_datetime(file_hour(files[0])) if files else None
+    since = (now - datetime.timedelta(hours=1)).strftime("%Y-%m-%d %H:%M:%S")
+    with connect(database) as cursor:
+        cursor.execute("SELECT MAX(hour) FROM hours")
+        (latest_db_hour,) = cursor.fetchone()
+        cursor.execute(dedent(f"""
+            SELECT remapped, COUNT(*), AVG(duration) FROM hours
+            WHERE processed >= '{since}'
+            GROUP BY remapped
+        """))
+        recent = { bool(remapped): (int(n), avg) for remapped, n, avg in cursor.fetchall() }
+    hours_per_hour, avg_duration = recent.get(False, (0, None))
+    remapped_per_hour, _ = recent.get(True, (0, None))
+    latest_db_hour = _as_datetime(latest_db_hour)
+    lag_hours = None
+    if latest_file_hour is not None and latest_db_hour is not None:
+        lag_hours = max(0, (latest_file_hour - latest_db_hour).total_seconds() / 3600)
+    file_age_hours = None
+    if latest_file_hour is not None:
+        file_age_hours = max(0, (now - latest_file_hour).total_seconds() / 3600)
+    return IngestionStatus(latest_file_hour, latest_db_hour, lag_hours, hours_per_hour,
+                           None if avg_duration is None else float(avg_duration),
+                           remapped_per_hour, file_age_hours)
+
+
+def monitor_jobs(sleep_secs=60, max_sleep_secs=None, qstat=QSTAT, 
+                 database=None, dir=DEFAULT_DIR, lag_threshold=3, stale_threshold=3,
+                 sleep=time.sleep, clock=datetime.datetime.utcnow):
+    """Continuously monitor jobs, yielding changes
+    
+    If ``database`` is given, also monitors ingestion lag and throughput,
+    reporting when they change and alerting when the lag crosses ``lag_threshold``,
+    or when the newest pageview file is older than ``stale_threshold``
+    (or there is none at all), i.e. the feed itself has stalled.
+    
+    Polling backs off (doubling up to ``max_sleep_secs``) while nothing changes, 
+    and returns to ``sleep_secs`` when anything changes or there is a backlog.
+    
+    Args:
+        sleep_secs: Minimum time between polls
+        max_sleep_secs: Maximum time between polls (default ``10 * sleep_secs``)
+        qstat: Path to ``qstat`` executable
+        database: Optional database to check for ingestion lag
+        dir: Directory of pageview files
+        lag_threshold: Lag in hours above which to alert
+        stale_threshold: Age in hours of the newest file above which to alert
+        sleep: Function used to wait between polls
+        clock: Function returning the current UTC time
+    """ 
+    if max_sleep_secs is None:
+        max_sleep_secs = 10 * sleep_secs
     previous = {}
+    previous_status = None
+    alerting = False
+    stale = False
+    delay = sleep_secs
     while True:
-        jobs = {j.num:j for j in job_status()}
+        changed = False
+        jobs = {j.num:j for j in job_status(qstat)}
         for num, job in jobs.items():
             if num not in previous:
+                changed = True
                 yield f"New job {num} ({job.name}): state={job.long_state}"
             elif previous[num].long_state != job.long_state:
+                changed = True
                 yield f"Changed state job {num} ({job.name}): {previous[num].long_state} -> {job.long_state}"
         for num, job in previous.items():
              if num not in jobs:
+                 changed = True
                  yield f"Completed job {num} ({job.name})"
         previous = jobs
-        time.sleep(sleep_secs)
+        
+        backlog = False
+        if database is not None:
+            status = ingestion_status(database, dir, clock())
+            if previous_status is None or status.latest_db_hour != previous_status.latest_db_hour \
+                or status.latest_file_hour != previous_status.latest_file_hour:
+                changed = True
+                yield (f"Ingestion: newest file {status.latest_file_hour}, "
+                       f"newest processed {status.latest_db_hour}, lag {status.lag_hours}h, "
+                       f"{status.hours_per_hour} hours processed in last hour, "
+                       f"average duration {status.avg_duration}s, "
+                       f"{status.remapped_per_hour} hours remapped")
+            previous_status = status
+            backlog = status.lag_hours is not None and status.lag_hours > 1
+            if status.lag_hours is not None and status.lag_hours > lag_threshold:
+                if not alerting:
+                    alerting = True
+                    yield f"ALERT: ingestion lag {status.lag_hours}h exceeds {lag_threshold}h"
+            elif alerting:
+                alerting = False
+                yield f"Recovered: ingestion lag {status.lag_hours}h"
+            if status.file_age_hours is None or status.file_age_hours > stale_threshold:
+                if not stale:
+                    stale = True
+                    yield (f"ALERT: no pageview files in {dir}" if status.latest_file_hour is None
+                           else f"ALERT: newest pageview file is {status.file_age_hours}h old, "
+                           f"exceeding {stale_threshold}h")
+            elif stale:
+                stale = False
+                yield f"Recovered: newest pageview file is {status.file_age_hours}h old"
+        
+        delay = sleep_secs if changed or backlog else min(2 * delay, max_sleep_secs)
+        sleep(delay)
 
 
 def print_jobs():
@@ -70,11 +209,25 @@ def parse_args(argv=None):
                         help="URL like https://hooks.slack.com/services/blah/blah/blah")
     parser.add_argument('--slack-channel', action='store',
                         help="channel like @general or user like #bob")
+    parser.add_argument('--database', '--db', 
+                        help='database name, to also monitor ingestion lag')
+    parser.add_argument('--dir', type=Path, default=DEFAULT_DIR,
+                        help="Directory of pageview files")
+    parser.add_argument('--lag-threshold', type=float, default=3,
+                        help="Ingestion lag in hours above which to alert")
+    parser.add_argument('--stale-threshold', type=float, default=3,
+                        help="Age in hours of the newest pageview file above which to alert")
+    parser.add_argument('--min-sleep', type=float, default=60,
+                        help="Minimum seconds between polls")
+    parser.add_argument('--max-sleep', type=float, default=600,
+                        help="Maximum seconds between polls")
+    parser.add_argument('--qstat', default=QSTAT, help="Path to qstat")
     args = parser.parse_args(argv)
     return args
 
 
 def slack_message(message, hook, channel):
+    import requests # Imported on demand as it is slow and only needed for Slack
     data = dict(text=message)
     if channel:
         data['channel'] = channel
@@ -84,7 +237,10 @@ def slack_message(message, hook, channel):
 
 def monitor():
     args = parse_args()
-    for message in monitor_jobs():
+    for message in monitor_jobs(sleep_secs=args.min_sleep, max_sleep_secs=args.max_sleep,
+                                qstat=args.qstat, database=args.database, dir=args.dir,
+                                lag_threshold=args.lag_threshold,
+                                stale_threshold=args.stale_threshold):
         print(message)
         if args.slack_hook:
             slack_message(message, args.slack_hook, args.slack_channel)
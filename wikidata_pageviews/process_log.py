@@ -5,26 +5,30 @@ Example::
 """
 
 import gzip
-#from collections import defaultdict, Counter
-from typing import NamedTuple
-#import os
+import json
+import os
+from collections import defaultdict, deque
+from operator import itemgetter
+from array import array
 import re
 import sys
 from textwrap import dedent
 import logging
-#import itertools
+import itertools
 import io
 import time
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta
 
-from tenacity import retry, wait_random_exponential
-import toolforge
-
 from .util import *
 from .constants import *
-from .project import database_from_project_name
+from .project import database_from_project_name, known_databases, set_known_databases, ProjectFilter
+from .batch import LogBatch, TitleBatch, TitleIndex
+from .checkpoint import Checkpoint
+from .writer import get_writer, WRITERS
 
 # E.g. pageviews-20181021-120000.gz
 FILE_RE = re.compile(r'^pageviews-\d{8}-\d{6}\.gz$')
@@ -42,6 +46,7 @@ def connect_to_database(dbname, **kargs):
     Returns:
         conn: Connection
     """
+    import toolforge # Imported on demand to keep start-up fast
     conn = toolforge.connect(dbname, 
                              #host=os.environ['MYSQL_HOST'],
                              #user=os.environ['MYSQL_USERNAME'],
@@ -60,7 +65,9 @@ def convert_titles_to_qids(dbname, titles):
     Returns:
         qids: Parallel list of Wikidata ids (or None)
     """
+    from tenacity import retry, wait_random_exponential # Imported on demand to keep start-up fast
     titles = list(titles) # reiterable
+    title_set = set(titles)
     results = dict()
     logger = logging.getLogger(__name__)
     
@@ -92,7 +99,7 @@ def convert_titles_to_qids(dbname, titles):
             # Probably historical.
             # To reduce memory overhead, we convert QIDs into integers.
             qid = int(qid.decode().upper()[1:])
-            if title not in titles:
+            if title not in title_set:
                 logger.error(f"Unexpected title {title} for QID Q{qid}")
             results[title] = qid
             n_results += 1
@@ -151,54 +158,275 @@ def convert_titles_to_qids(dbname, titles):
 
     return [ results.get(title) for title in titles ]
     
-class LogEntry(NamedTuple):
-    """Lightweight class representing a line from the log file"""
-    project: str
-    title: str
-    views: int
+def _parse_lines(lines, batch_size, project_filter=None):
+    """Parse log lines into columnar batches
+    
+    Args:
+        lines: Iterable of raw lines
+        batch_size: Maximum number of entries per batch
+        project_filter: Optional function taking raw project bytes, 
+            returning False for lines that should only be counted
         
-    def dbname(self):
-        return database_from_project_name(self.project)
+    Yields:
+        batch: ``LogBatch`` sharing a single project interning table
+    """
+    projects = [] # Interning table shared by all batches
+    project_ids = dict() # Project bytes to id, or -1 if filtered
+    batch = LogBatch(projects)
+    for line in lines:
+        project = line[:line.index(b' ')]
+        project_id = project_ids.get(project)
+        if project_id is None:
+            if project_filter is None or project_filter(project):
+                project_id = len(projects)
+                projects.append(project.decode())
+            else:
+                project_id = -1
+            project_ids[project] = project_id
+        if project_id < 0:
+            batch.filtered_lines += 1
+            batch.filtered_views += int(line.rsplit(b' ', 2)[1])
+            continue
+        _, title, views, _ = line.split(b' ')
+        batch.project_ids.append(project_id)
+        batch.buffer += title
+        batch.offsets.append(len(batch.buffer))
+        batch.views.append(int(views))
+        if len(batch.views) == batch_size:
+            yield batch
+            batch = LogBatch(projects)
+    if len(batch) or batch.filtered_lines:
+        yield batch
+
+
+def read_log(file, batch_size=1<<16, project_filter=None):
+    """Read the gzipped logfile and yield columnar batches of log entries
     
+    Args:
+        file: Path to hourly log file
+        batch_size: Maximum number of entries per batch
+        project_filter: Optional ``ProjectFilter`` applied before parsing each line
+        
+    Yields:
+        batch: ``LogBatch`` sharing a single project interning table
+    """
+    with io.BufferedReader(gzip.GzipFile(file, 'r')) as f:
+        yield from _parse_lines(f, batch_size, project_filter)
 
-def read_log(file):
-    """Read the gzipped logfile and yield log entries"""
+
+def read_shards(file, shard_size=DEFAULT_SHARD_SIZE):
+    """Decompress the logfile into line-aligned blocks
+    
+    Args:
+        file: Path to hourly log file
+        shard_size: Approximate size of each block in bytes
+        
+    Yields:
+        shard: Bytes containing whole lines
+    """
     with io.BufferedReader(gzip.GzipFile(file, 'r')) as f:
-        for line in f.readlines():
-            project, title, views, _ = line.decode().split(' ')
-            yield LogEntry(project, title, int(views))
+        while True:
+            shard = f.read(shard_size)
+            if not shard:
+                break
+            if not shard.endswith(b'\n'):
+                shard += f.readline()
+            yield shard
+
+
+def _init_parse_worker(databases):
+    """Share the sitematrix with a worker process"""
+    set_known_databases(databases)
+
+
+def _parse_shard(shard, project_filter=None):
+    """Parse and partition a shard (in a worker process)
+    
+    Returns:
+        partitions: Dictionary from project name to ``TitleBatch``
+    """
+    lines = shard.splitlines()
+    partitions = dict()
+    for batch in _parse_lines(lines, len(lines), project_filter):
+        partitions = batch.partition(_project_name)
+    return partitions
+
+
+def read_log_parallel(file, workers, shard_size=DEFAULT_SHARD_SIZE, project_filter=None):
+    """Read the gzipped logfile, parsing and partitioning in a pool of processes.
+    
+    The file is decompressed once in this process and split into line-aligned
+    shards, which are parsed by the pool.  At most twice as many shards as
+    there are workers are held at once.
+    
+    Args:
+        file: Path to hourly log file
+        workers: Number of worker processes
+        shard_size: Approximate size of each shard in bytes
+        project_filter: Optional ``ProjectFilter`` applied before parsing each line
+        
+    Yields:
+        partitions: Dictionary from project name to ``TitleBatch`` for each shard,
+            in file order
+    """
+    context = multiprocessing.get_context('spawn') # Safe to use from threads
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_parse_worker, 
+                             initargs=(known_databases(),)) as executor:
+        pending = deque()
+        for shard in read_shards(file, shard_size):
+            pending.append(executor.submit(_parse_shard, shard, project_filter))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_log_partitions(file, workers=1, project_filter=None, shard_size=DEFAULT_SHARD_SIZE):
+    """Read the logfile serially or in parallel according to ``workers``
+    
+    The serial path yields a batch for every 65536 lines, and the parallel
+    path one for every shard, so chunks of titles differ between the two.
+    
+    Returns:
+        log_batches: Iterable suitable for ``process_log_entries``
+    """
+    if workers > 1:
+        return read_log_parallel(file, workers, shard_size, project_filter)
+    return read_log(file, project_filter=project_filter)
+
+
+def _project_name(project):
+    """Partitioning key for ``LogBatch.partition`` that keeps projects apart"""
+    return project
+
+
+def partition_by_project(log_batches):
+    """Split log batches by project name
+    
+    Args:
+        log_batches: Iterable of ``LogBatch``, or of dictionaries already 
+            partitioned by project name (as from ``read_log_parallel``)
+        
+    Yields:
+        project: Project name (or None for the counts of filtered lines)
+        titles: ``TitleBatch`` for that project
+    """
+    for log_batch in log_batches:
+        if isinstance(log_batch, dict):
+            yield from log_batch.items()
+        else:
+            yield from log_batch.partition(_project_name).items()
+
+
+def by_database(partitions):
+    """Map (project, titles) pairs to (dbname, titles) pairs
+    
+    The database name is None if the project cannot be mapped, or for the
+    counts of filtered lines.
+    """
+    for project, titles in partitions:
+        yield (database_from_project_name(project) if project is not None else None, titles)
+
+
+def partition_log_batches(log_batches):
+    """Split log batches by database name
+    
+    Args:
+        log_batches: Iterable as for ``partition_by_project``
+        
+    Yields:
+        dbname: Database name (or None if project cannot be mapped)
+        titles: ``TitleBatch`` for one project of that database
+    """
+    return by_database(partition_by_project(log_batches))
 
 QID_RE = re.compile(r'^Q(\d+)$')
+
+def convert_titles(dbname, titles):
+    """Convert titles into Wikidata ids, handling Wikidata itself specially.
+    
+    Args:
+        dbname: Database name
+        titles: Iterable of page titles
+        
+    Returns:
+        qids: Parallel list of Wikidata ids (or None)
+    """
+    if dbname == 'wikidatawiki':
+        qids = [ int(title[1:]) 
+                if QID_RE.search(title) else None for title in titles ]
+        logging.getLogger(__name__).info(f"Wikidata special case: {len(qids)} "
+                                         f"converted to {sum(qid is not None for qid in qids)}")
+        return qids
+    return convert_titles_to_qids(dbname, titles)
             
-def process_log_entries(log_entries):
+def process_log_entries(log_batches, chunk_size=10000, max_buckets=1000, max_bytes=None,
+                        checkpoint=None, workers=1, max_pending=None, unresolved=None):
     """Process log entries into (qid,views) pairs.
     Additionally yields two "logging" pairs to report unconverted entries.
+    
+    Parsing and partitioning run in one thread while chunks of titles are
+    resolved in ``workers`` others, so that the next chunk is prepared while
+    the current lookup is in flight.
+    
+    Args:
+        log_batches: Iterable of ``LogBatch``, as from ``read_log``, or of partitions
+            as from ``read_log_parallel``
+        chunk_size: Approximate number of titles to convert at once
+        max_buckets: Maximum number of databases to hold unconverted titles for
+        max_bytes: Maximum size in bytes of titles held before conversion
+        checkpoint: Optional ``Checkpoint`` used to save and reuse resolved chunks
+        workers: Number of threads resolving chunks (zero to run inline)
+        max_pending: Maximum number of chunks queued between stages
+        unresolved: Optional ``SpaceSaving`` sketch updated with the views of
+            each (dbname, title) that could not be converted
     """
     unconverted_titles = 0
     unconverted_views = 0
     logger = logging.getLogger(__name__)
-    for dbname, log_entries in chunk_and_partition(log_entries, key=lambda le: le.dbname(), 
-                                                   max_buckets=3, chunk_size=10000):
+    
+    def resolve(chunk):
+        """Returns database name, titles, and parallel (qids, views) arrays
+        for a chunk, with unconverted titles recorded against QID 0.
+        """
+        i, (dbname, batches) = chunk
+        batch = TitleBatch.concatenate(titles for _, titles in batches)
         if dbname is None:
-            views = [le.views for le in log_entries]
-            unconverted_titles += len(views)
-            unconverted_views += sum(views)
-            continue
-        titles = (le.title for le in log_entries)
-        if dbname == 'wikidatawiki':
-            qids = [ int(title[1:]) 
-                    if QID_RE.search(title) else None for title in titles ]
-            logger.info(f"Wikidata special case: {len(log_entries)} "
-                        "converted to {sum(qid is not None for qid in qids)}")
+            # Titles of unmapped projects, along with the counts of filtered lines
+            return (None, batch, None, None)
+        qids = checkpoint.load_chunk(i, dbname, batch) if checkpoint is not None else None
+        if qids is None:
+            qids = array('I', (qid or 0 for qid in convert_titles(dbname, batch.titles())))
+            if checkpoint is not None:
+                checkpoint.save_chunk(i, dbname, batch, qids)
         else:
-            qids = convert_titles_to_qids(dbname, titles)
-            
-        for le, qid in zip(log_entries, qids):
-            if qid is not None:
-                yield (qid, le.views)
+            logger.info(f"Reusing checkpoint for chunk {i} ({dbname})")
+        return (dbname, batch, qids, batch.views)
+    
+    chunks = enumerate(chunk_and_partition(partition_log_batches(log_batches), 
+                                           key=itemgetter(0), size=lambda p: len(p[1]),
+                                           max_buckets=max_buckets, chunk_size=chunk_size,
+                                           max_bytes=max_bytes, sizeof=lambda p: p[1].nbytes()))
+    for dbname, batch, qids, views in pipelined_map(resolve, chunks, workers=workers, 
+                                                    max_pending=max_pending):
+        if dbname is None:
+            unconverted_titles += batch.n_lines()
+            unconverted_views += batch.total_views()
+            continue
+        track = unresolved is not None
+        missing = dict() # Views of each unconverted title in the chunk
+        for i, (qid, v) in enumerate(zip(qids, views)):
+            if qid != 0:
+                yield (qid, v)
             else:
                 unconverted_titles += 1
-                unconverted_views += le.views
+                unconverted_views += v
+                if track:
+                    title = batch.title(i)
+                    missing[title] = missing.get(title, 0) + v
+        # The sketch is fed once per distinct title, not once per line
+        for title, v in missing.items():
+            unresolved.add((dbname, title.decode()), v)
     logger.warning(f"Failed to convert {unconverted_titles} titles representing {unconverted_views} views")
     yield (0, unconverted_views) # File these under a fake id so they're in our total
     
@@ -214,74 +442,311 @@ def file_hour(file):
     return f"{m.group(1)}-{m.group(2)}-{m.group(3)}T{m.group(4)}:00:00"        
 
 
-def write_to_database(database, qid_views, start_time, filename):
+def write_to_database(database, qid_views, start_time, filename, writer=None, unresolved=None,
+                      replace_hour=False):
     """Write results to database
+    
+    This is idempotent: rows left behind by an interrupted earlier attempt
+    are replaced rather than causing duplicate-key failures.
 
     Args:
         database: Name of database
         qid_views: Iterable of QID (e.g. Q42) and view count pairs
             Each qid should appear at most once
-        hour: YYYY-MM-DDTHH:0000 formatted hour
         start_time: time.time() object from start of run
         filename: Name of log file processed
+        writer: Optional ``Writer``, by default chosen according to ``database``
+        unresolved: Optional ``SpaceSaving`` sketch of unresolved (dbname, title) pairs
+        replace_hour: Delete any existing rows for the hour first
     """
-    logger = logging.getLogger(__name__)
-    hour = file_hour(filename)
-    data = [ (qid, hour, views) for qid ,views in qid_views]
-    n_qids = len(data)
-    max_qid = max(x[0] for x in data)
-    views = sum(x[2] for x in data)
-    # https://stackoverflow.com/a/13154531
-    with connect_to_database(database, cluster="tools",
-                             local_infile = 1) as cursor:
-        batch_insert(cursor, 'qid_hourly_views', data)
-        duration = time.time() - start_time
-        sql = dedent(f"""
-            INSERT INTO hours
-            SET file = {cursor.connection.escape(filename)},
-                hour = {cursor.connection.escape(hour)}, 
-                duration = {duration}, 
-                views = {views}, 
-                max_qid = {max_qid}, 
-                n_qids = {n_qids}
-        """)
-        logger.info(sql)
-        cursor.execute(sql)
-
-def check_for_existing(database, filename):
+    if writer is None:
+        writer = get_writer(database)
+    writer.write_hour(filename, file_hour(filename), qid_views, start_time, unresolved,
+                      replace_hour)
+
+def check_for_existing(database, filename, writer=None):
     """Returns true iff there is alreadys a record for this filename."""
-    with connect_to_database(database, cluster="tools",
-                             local_infile = 1) as cursor:
-        sql = dedent(f"""
-            SELECT 1 FROM hours 
-                WHERE file = {cursor.connection.escape(filename)}
-	""")
-        cursor.execute(sql)
-        return cursor.rowcount != 0
+    if writer is None:
+        writer = get_writer(database)
+    return writer.exists(filename)
 
 
-def process_file(file, database=DEFAULT_DATABASE):
+def process_file(file, database=DEFAULT_DATABASE, work_dir=None, workers=1, max_pending=None,
+                 writer=None, max_buckets=1000, max_bytes=DEFAULT_MAX_BYTES, parse_workers=1,
+                 project_filter=None, title_store=None):
     """Do complete job of reading log file and storing in database.
     
+    If ``work_dir`` is given, resolved chunks and the final aggregation
+    are checkpointed there, so that an interrupted run can be resumed
+    without repeating replica lookups.
+    
     Args:
         file: Path to hourly log file
         database: Name of database to store results in
+        work_dir: Optional directory for checkpoints
+        workers: Number of threads resolving titles
+        max_pending: Maximum number of chunks queued between pipeline stages
+        writer: Optional ``Writer``, by default chosen according to ``database``
+        max_buckets: Maximum number of databases to hold unconverted titles for
+        max_bytes: Maximum size in bytes of titles held before conversion
+        parse_workers: Number of processes decompressing and parsing the file
+        project_filter: Optional ``ProjectFilter``; by default only projects
+            that map to a known database are parsed (or all, with a ``title_store``)
+        title_store: Optional ``TitleStore`` in which to keep the hour's title views,
+            so that it can later be remapped (see ``remap_hours``)
     Return:
         status: True if file processed
     """
     logger = logging.getLogger(__name__)
     logger.info(f"Starting to process file {file}")
-    if check_for_existing(database, file.name):
+    if check_for_existing(database, file.name, writer):
         logger.warning(f"Record already exists for file {file}")
         return False
     start_time = time.time()
-    log_entries = read_log(file)
-    qid_views = process_log_entries(log_entries)
-    qid_views = sum_values(qid_views)
-    write_to_database(database, qid_views.items(), start_time, file.name)     
-    logger.info(f"File {file} done with {len(qid_views)} QIDs") 
+    chunk_size = 10000
+    if project_filter is None:
+        project_filter = ProjectFilter(unmapped=title_store is not None)
+    from .sketch import SpaceSaving # Imported on demand as ``sketch`` needs numpy
+    checkpoint = None
+    aggregate = None
+    unresolved = None
+    if work_dir is not None:
+        # Everything that affects how titles are chunked: parsing in parallel
+        # reorders lines by shard, but the number of workers does not matter
+        params = dict(chunk_size=chunk_size, max_buckets=max_buckets, max_bytes=max_bytes,
+                      projects=project_filter.params(), parallel=parse_workers > 1,
+                      shard_size=DEFAULT_SHARD_SIZE)
+        checkpoint = Checkpoint(work_dir, file, params)
+        if title_store is None or title_store.has_hour(file.name):
+            aggregate = checkpoint.load_aggregate()
+            unresolved = checkpoint.load_unresolved()
+    if aggregate is None:
+        unresolved = SpaceSaving(DEFAULT_UNRESOLVED_SIZE)
+        log_entries = read_log_partitions(file, parse_workers, project_filter, DEFAULT_SHARD_SIZE)
+        if title_store is not None:
+            recorder = title_store.recorder()
+            log_entries = ({ project: titles } 
+                           for project, titles in recorder.record(partition_by_project(log_entries)))
+        qid_views = process_log_entries(log_entries, chunk_size=chunk_size, 
+                                        max_buckets=max_buckets, max_bytes=max_bytes,
+                                        checkpoint=checkpoint,
+                                        workers=workers, max_pending=max_pending,
+                                        unresolved=unresolved)
+        qid_views = sum_values(qid_views)
+        aggregate = (array('I', qid_views.keys()), array('Q', qid_views.values()))
+        if title_store is not None:
+            recorder.save(file.name)
+        if checkpoint is not None:
+            checkpoint.save_unresolved(unresolved)
+            checkpoint.save_aggregate(*aggregate)
+    else:
+        logger.info(f"Reusing aggregate checkpoint for file {file}")
+    write_to_database(database, zip(*aggregate), start_time, file.name, writer, unresolved)
+    if checkpoint is not None:
+        checkpoint.clear()
+    logger.info(f"File {file} done with {len(aggregate[0])} QIDs") 
     return True
 
+def process_files(files, database=DEFAULT_DATABASE, workers=1, write_workers=1, max_pending=None,
+                  writer=None, parse_workers=1, project_filter=None, title_store=None):
+    """Process several hourly log files together.
+    
+    Titles are deduplicated per database across all of the files, so each
+    distinct title is resolved only once, but results are still stored
+    separately for each hour.  Memory use grows with the number of distinct
+    titles across the batch.  Databases are resolved in parallel, and each 
+    hour is aggregated while the previous one is being written.
+    
+    Args:
+        files: Paths to hourly log files
+        database: Name of database to store results in
+        workers: Number of threads resolving titles
+        write_workers: Number of threads writing hours to the database
+        max_pending: Maximum number of items queued between pipeline stages
+        writer: Optional ``Writer``, by default chosen according to ``database``
+        parse_workers: Number of processes decompressing and parsing each file
+        project_filter: Optional ``ProjectFilter``; by default only projects
+            that map to a known database are parsed (or all, with a ``title_store``)
+        title_store: Optional ``TitleStore`` in which to keep each hour's title views
+    Return:
+        n_processed: Number of files processed
+    """
+    from .sketch import SpaceSaving # Imported on demand as ``sketch`` needs numpy
+    logger = logging.getLogger(__name__)
+    files = [ file for file in files if not check_for_existing(database, file.name, writer) ]
+    if not files:
+        return 0
+    logger.info(f"Starting to process batch of {len(files)} files")
+    if project_filter is None:
+        project_filter = ProjectFilter(unmapped=title_store is not None)
+    start_time = time.time()
+    indexes = defaultdict(TitleIndex)
+    hours = []
+    for file in files:
+        logger.info(f"Reading file {file}")
+        title_views = defaultdict(lambda: (array('I'), array('I')))
+        unconverted_titles = 0
+        unconverted_views = 0
+        partitions = partition_by_project(read_log_partitions(file, parse_workers, project_filter))
+        if title_store is not None:
+            recorder = title_store.recorder()
+            partitions = recorder.record(partitions)
+        for dbname, titles in by_database(partitions):
+            if dbname is None:
+                unconverted_titles += titles.n_lines()
+                unconverted_views += titles.total_views()
+                continue
+            ids, views = title_views[dbname]
+            ids.extend(indexes[dbname].add(titles))
+            views.extend(titles.views)
+        if title_store is not None:
+            recorder.save(file.name)
+        hours.append((file, title_views, unconverted_titles, unconverted_views))
+        
+    def resolve(item):
+        dbname, index = item
+        return (dbname, convert_titles(dbname, index.titles()))
+    
+    qids = dict(pipelined_map(resolve, indexes.items(), workers=workers, max_pending=max_pending))
+    logger.info(f"Resolved {sum(len(index) for index in indexes.values())} distinct titles "
+                f"for {len(files)} files")
+    
+    # Charge each hour an equal share of the time spent so far
+    share = (time.time() - start_time) / len(files)
+    
+    titles_by_id = dict() # For databases with unconverted titles
+    
+    def aggregate():
+        """Yields (file, qid_views, unresolved) for each hour"""
+        for file, title_views, unconverted_titles, unconverted_views in hours:
+            qid_views = dict()
+            unresolved = SpaceSaving(DEFAULT_UNRESOLVED_SIZE)
+            for dbname, (ids, views) in title_views.items():
+                db_qids = qids[dbname]
+                missing = dict() # Views of each unconverted title id
+                for title_id, v in zip(ids, views):
+                    qid = db_qids[title_id]
+                    if qid is not None:
+                        qid_views[qid] = qid_views.get(qid, 0) + v
+                    else:
+                        unconverted_titles += 1
+                        unconverted_views += v
+                        missing[title_id] = missing.get(title_id, 0) + v
+                if missing and dbname not in titles_by_id:
+                    titles_by_id[dbname] = list(indexes[dbname].titles())
+                for title_id, v in missing.items():
+                    unresolved.add((dbname, titles_by_id[dbname][title_id]), v)
+            logger.warning(f"Failed to convert {unconverted_titles} titles representing "
+                           f"{unconverted_views} views in {file}")
+            qid_views[0] = qid_views.get(0, 0) + unconverted_views
+            yield (file, qid_views, unresolved)
+            
+    def write(item):
+        file, qid_views, unresolved = item
+        write_to_database(database, qid_views.items(), time.time() - share, file.name, writer,
+                          unresolved)
+        logger.info(f"File {file} done with {len(qid_views)} QIDs") 
+        
+    for _ in pipelined_map(write, aggregate(), workers=write_workers, max_pending=max_pending):
+        pass
+    return len(files)
+
+def open_title_store(path):
+    """Returns a ``TitleStore`` for a directory, or None if no directory is given"""
+    if path is None:
+        return None
+    from .titlestore import TitleStore # Imported on demand as it needs numpy
+    return TitleStore(path)
+
+
+def remap_hours(title_store, database=DEFAULT_DATABASE, start=None, end=None, workers=1, 
+                max_pending=None, writer=None, batch_hours=24):
+    """Recompute hourly results from saved title views, without reading the logs.
+    
+    This corrects history after sitelinks or redirects change, or after a fix 
+    to title conversion.  Within each batch of hours, each distinct title is 
+    resolved once, and every hour is then rewritten, replacing its existing rows.
+    
+    Args:
+        title_store: ``TitleStore`` written by ``process_file`` or ``process_files``
+        database: Name of database to store results in
+        start: First hour to remap, like "2018-10-10T01" (default earliest)
+        end: Last hour to remap, like "2018-10-10T01" (default latest)
+        workers: Number of threads resolving titles
+        max_pending: Maximum number of items queued between pipeline stages
+        writer: Optional ``Writer``, by default chosen according to ``database``
+        batch_hours: Number of hours to resolve together
+    Return:
+        n_remapped: Number of hours rewritten
+    """
+    import numpy as np
+    from .sketch import SpaceSaving
+    logger = logging.getLogger(__name__)
+    files = [ file for file in title_store.hour_files() 
+             if (start is None or file_hour(file.name)[:13] >= start) 
+             and (end is None or file_hour(file.name)[:13] <= end) ]
+    logger.info(f"Remapping {len(files)} hours")
+    for batch in chunks(files, batch_hours):
+        start_time = time.time()
+        hours = [ title_store.read_hour(file) for file in batch ]
+        ids_by_project = defaultdict(list)
+        for _, entries, _ in hours:
+            for project, (ids, _) in entries.items():
+                ids_by_project[project].append(ids)
+        distinct = { project: np.unique(np.concatenate(parts)) 
+                    for project, parts in ids_by_project.items() }
+        # Map projects afresh, so that fixes to the mapping apply to old hours
+        dbnames = { project: database_from_project_name(project) for project in distinct }
+        projects_by_db = defaultdict(list)
+        for project, dbname in dbnames.items():
+            if dbname is not None:
+                projects_by_db[dbname].append(project)
+
+        def resolve(item):
+            """Resolve the distinct titles of all of a database's projects at once"""
+            dbname, projects = item
+            titles = { project: title_store.titles(project, distinct[project].tolist()) 
+                      for project in projects }
+            unique = list(dict.fromkeys(title for project in projects for title in titles[project]))
+            by_title = dict(zip(unique, convert_titles(dbname, unique)))
+            return [ (project, np.array([ by_title[title] or 0 for title in titles[project] ],
+                                        dtype=np.int64))
+                    for project in projects ]
+
+        qids = dict(itertools.chain.from_iterable(
+            pipelined_map(resolve, projects_by_db.items(), workers=workers, 
+                          max_pending=max_pending)))
+        logger.info(f"Resolved {sum(len(distinct[project]) for project in qids)} distinct titles "
+                    f"for {len(hours)} hours")
+        share = (time.time() - start_time) / len(hours)
+        for filename, entries, filtered_views in hours:
+            hour_qids = [ np.zeros(1, dtype=np.int64) ]
+            hour_views = [ np.array([filtered_views], dtype=np.int64) ]
+            unresolved = SpaceSaving(DEFAULT_UNRESOLVED_SIZE)
+            for project, (ids, views) in entries.items():
+                dbname = dbnames[project]
+                if dbname is None:
+                    hour_views[0] += int(views.sum(dtype=np.int64))
+                    continue
+                project_qids = qids[project][np.searchsorted(distinct[project], ids)]
+                missing = np.flatnonzero(project_qids == 0)
+                for title, v in zip(title_store.titles(project, ids[missing].tolist()), 
+                                    views[missing].tolist()):
+                    unresolved.add((dbname, title), v)
+                hour_qids.append(project_qids)
+                hour_views.append(views.astype(np.int64))
+            all_qids, inverse = np.unique(np.concatenate(hour_qids), return_inverse=True)
+            all_views = np.zeros(len(all_qids), dtype=np.int64)
+            np.add.at(all_views, inverse, np.concatenate(hour_views))
+            logger.warning(f"Failed to convert titles representing {all_views[0]} views "
+                           f"in {filename}")
+            write_to_database(database, zip(all_qids.tolist(), all_views.tolist()), 
+                              time.time() - share, filename, writer, unresolved, 
+                              replace_hour=True)
+            logger.info(f"Remapped {filename} with {len(all_qids)} QIDs")
+    return len(files)
+
+
 def parse_args(argv=None):
     if argv is None:
         argv = sys.argv[1:]
@@ -293,26 +758,103 @@ def parse_args(argv=None):
     parser.add_argument("-n", "--max-files", type=int, default=10,
                         help="Maximum number of files to process")
     parser.add_argument("--maxdays", type=int, default=7, help="Maximum age of file to process in days")
+    parser.add_argument("--work-dir", type=Path, default=None,
+                        help=f"Directory for checkpoints to resume interrupted files "
+                        f"(default {DEFAULT_WORK_DIR})")
+    parser.add_argument("--no-checkpoints", action='store_true', help="Disable checkpoints")
+    parser.add_argument("-b", "--batch-hours", type=int, default=1,
+                        help="Number of hourly files to process together, resolving their titles once")
+    parser.add_argument("--allow-projects", type=lambda s: s.split(','), default=None,
+                        help="Comma-separated project or database names to process exclusively")
+    parser.add_argument("--deny-projects", type=lambda s: s.split(','), default=None,
+                        help="Comma-separated project or database names to skip")
+    parser.add_argument("--parse-workers", type=int, default=1,
+                        help="Number of processes parsing each file")
+    parser.add_argument("--resolve-workers", type=int, default=1,
+                        help="Number of threads resolving titles against the replicas (0 for none)")
+    parser.add_argument("--write-workers", type=int, default=1,
+                        help="Number of threads writing hours in batch mode (0 for none)")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Maximum number of items queued between pipeline stages")
+    parser.add_argument("--max-buckets", type=int, default=None,
+                        help="Maximum number of wikis to hold unresolved titles for (default 1000)")
+    parser.add_argument("--max-bytes", type=int, default=None,
+                        help=f"Maximum size in bytes of titles held before resolving "
+                        f"(default {DEFAULT_MAX_BYTES})")
+    parser.add_argument("--writer", choices=WRITERS.keys(), default=None,
+                        help="Bulk-write backend (default depends on database name)")
+    parser.add_argument("--write-chunk-size", type=int, default=None,
+                        help="Number of rows to write at once")
+    parser.add_argument("--title-store", type=Path, default=None,
+                        help="Directory in which to keep title views for later remapping")
     logger = logging.getLogger(__name__)
     args = parser.parse_args(argv)
+    if args.batch_hours > 1:
+        # Batch mode resolves every distinct title at once, without chunks or checkpoints
+        unsupported = [ option for option, value in (('--work-dir', args.work_dir),
+                                                     ('--max-buckets', args.max_buckets),
+                                                     ('--max-bytes', args.max_bytes))
+                       if value is not None ]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be used with --batch-hours > 1")
+    if args.no_checkpoints:
+        args.work_dir = None
+    elif args.work_dir is None:
+        args.work_dir = DEFAULT_WORK_DIR
+    if args.max_buckets is None:
+        args.max_buckets = 1000
+    if args.max_bytes is None:
+        args.max_bytes = DEFAULT_MAX_BYTES
     log_level = logging.DEBUG if args.debug else logging.INFO if args.verbose else logging.WARNING
     logger.setLevel(log_level)
     logger.info(argv)
     logger.info(args)    
+    return args
     
 
-def get_earliest_file(dir, max_days):
+def parse_remap_args(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser(description="Recompute hourly results from saved title views")
+    parser.add_argument('-v', '--verbose', action='store_true', help='Increases log level to INFO')
+    parser.add_argument('-d', '--debug', action='store_true', help='Increases log level to DEBUG')    
+    parser.add_argument('title_store', type=Path, help="Directory given as --title-store")
+    parser.add_argument('--database', '--db', help='database name', default=DEFAULT_DATABASE)
+    parser.add_argument('--start', help="First hour to remap, e.g. 2018-10-10T17")
+    parser.add_argument('--end', help="Last hour to remap, e.g. 2018-10-16T23")
+    parser.add_argument("-b", "--batch-hours", type=int, default=24,
+                        help="Number of hours to resolve titles for together")
+    parser.add_argument("--resolve-workers", type=int, default=1,
+                        help="Number of threads resolving titles against the replicas (0 for none)")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="Maximum number of items queued between pipeline stages")
+    parser.add_argument("--writer", choices=WRITERS.keys(), default=None,
+                        help="Bulk-write backend (default depends on database name)")
+    parser.add_argument("--write-chunk-size", type=int, default=None,
+                        help="Number of rows to write at once")
+    logger = logging.getLogger(__name__)
+    args = parser.parse_args(argv)
+    log_level = logging.DEBUG if args.debug else logging.INFO if args.verbose else logging.WARNING
+    logger.setLevel(log_level)
+    logger.info(argv)
+    logger.info(args)    
+    return args
+
+
+def get_earliest_file(dir, max_days, now=None):
     """It's expensive to traverse the entire directory structure, 
     so we short-circuit any directories or files that cannot be recent.
     
     Args:
         dir: Base directory to traverse from.  
         max_days: Number of days to go back
+        now: Current UTC time (default now), as files are named by UTC hour
         
     Returns:
         file: Path to predicted earliest file (may not exist)
     """
-    now = datetime.now()
+    if now is None:
+        now = datetime.utcnow()
     delta = timedelta(days=max_days)
     dt = now - delta
     file = dir / dt.strftime('%Y') / dt.strftime('%Y-%m') / dt.strftime('pageviews-%Y%m%d-%H%M%S.gz')
@@ -320,12 +862,13 @@ def get_earliest_file(dir, max_days):
     return file
     
 
-def get_files(dir, max_days):
+def get_files(dir, max_days, now=None):
     """Smart traverse of directory structure using earliest file as cutoff.
     
     Args:
         dir: Directory to traverse
         max_days: Maximum number of days to go back before now.
+        now: Current UTC time (default now)
         
     Returns:
         files: Paths from most recent backwards
@@ -350,15 +893,89 @@ def get_files(dir, max_days):
                     #logger.info(f"File {path} is older than {earliest_file}")
 
     logger = logging.getLogger(__name__)
-    earliest_file = get_earliest_file(dir, max_days)
+    earliest_file = get_earliest_file(dir, max_days, now)
     files = sorted(gen(dir), reverse=True)   
     logger.info(f"Going to process {len(files)} files: {files}")
     return files
 
     
+def idle_marker(work_dir):
+    """Path of the file noting, for each database, the newest file when none were pending"""
+    return Path(work_dir) / 'idle.json'
+
+
+def get_pending_files(files, writer, work_dir=None):
+    """Returns the files without an existing record, using a single query
+    
+    If ``work_dir`` is given, the newest file is noted there whenever nothing
+    is pending.  While it remains the newest, nothing can be pending, so the
+    database is not queried (or even connected to).  A file older than the
+    newest that appears late is found once a newer file arrives.
+    
+    Args:
+        files: Paths from most recent backwards, as from ``get_files``
+        writer: ``Writer`` for the database
+        work_dir: Optional directory in which to keep the marker
+    """
+    logger = logging.getLogger(__name__)
+    markers = dict()
+    if work_dir is not None:
+        try:
+            with open(idle_marker(work_dir)) as f:
+                markers = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if files and markers.get(writer.database) == files[0].name:
+            logger.info(f"Newest file {files[0].name} was already processed")
+            return []
+    existing = writer.existing(file.name for file in files)
+    pending = [ file for file in files if file.name not in existing ]
+    if work_dir is not None and files and not pending:
+        markers[writer.database] = files[0].name
+        marker = idle_marker(work_dir)
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        tmp = marker.with_name(f"{marker.name}.{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(markers, f)
+        os.replace(tmp, marker)
+    return pending
+
+    
 def main(argv=None):
     args = parse_args(argv)
     assert args.dir.is_dir()
-    files = get_files(args.dir, args.maxdays)
-    iterate_until_n_succeed(lambda file: process_file(file, args.database), 
-                            files, args.max_files)
+    writer = get_writer(args.database, args.writer, args.write_chunk_size)
+    files = get_pending_files(get_files(args.dir, args.maxdays), writer, args.work_dir)
+    if not files:
+        logging.getLogger(__name__).info("Nothing to do")
+        return
+    # Titles of unmapped projects are kept too, in case the mapping is fixed later
+    project_filter = ProjectFilter(args.allow_projects, args.deny_projects,
+                                   unmapped=args.title_store is not None)
+    title_store = open_title_store(args.title_store)
+    if args.batch_hours > 1:
+        for batch in chunks(files[:args.max_files], args.batch_hours):
+            process_files(list(batch), args.database, workers=args.resolve_workers,
+                          write_workers=args.write_workers, max_pending=args.queue_size,
+                          writer=writer, parse_workers=args.parse_workers,
+                          project_filter=project_filter, title_store=title_store)
+    else:
+        iterate_until_n_succeed(lambda file: process_file(file, args.database, args.work_dir,
+                                                          workers=args.resolve_workers,
+                                                          max_pending=args.queue_size,
+                                                          writer=writer,
+                                                          max_buckets=args.max_buckets,
+                                                          max_bytes=args.max_bytes,
+                                                          parse_workers=args.parse_workers,
+                                                          project_filter=project_filter,
+                                                          title_store=title_store), 
+                                files, args.max_files)
+
+
+def remap(argv=None):
+    args = parse_remap_args(argv)
+    assert args.title_store.is_dir()
+    writer = get_writer(args.database, args.writer, args.write_chunk_size)
+    remap_hours(open_title_store(args.title_store), args.database, args.start, args.end,
+                workers=args.resolve_workers, max_pending=args.queue_size, writer=writer,
+                batch_hours=args.batch_hours)
@@ -7,8 +7,6 @@ Example::
     # -> 'enwiki'
 """
 
-from toolforge import _fetch_sitematrix
-
 # These elements must be combined with the language
 # e.g. en.z -> enwiki
 _suffix_map = dict(
@@ -38,6 +36,19 @@ _special_map = { 'be_tarask': 'be_x_oldwiki' }
 
 _databases = None # Lazy
 
+def known_databases():
+    """Returns set of public database names, fetching the sitematrix on first use"""
+    global _databases
+    if _databases is None:
+        from toolforge import _fetch_sitematrix
+        _databases = set(_sitematrix_database_names(_fetch_sitematrix()['sitematrix']))
+    return _databases
+
+def set_known_databases(databases):
+    """Supply the set of database names, e.g. in a worker process, to avoid a fetch"""
+    global _databases
+    _databases = databases
+
 def database_from_project_name(project_name:str) -> str:
     """Find database name corresponding to project name
     
@@ -47,10 +58,6 @@ def database_from_project_name(project_name:str) -> str:
     https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#Naming_conventions 
     and https://quarry.wmflabs.org/query/4031
     suitable for use with toolforge.connect()"""
-    global _databases
-    if _databases is None:
-        _databases = set(_sitematrix_database_names(_fetch_sitematrix()['sitematrix']))
-    
     labels = project_name.split('.')
     result = None
     
@@ -73,10 +80,54 @@ def database_from_project_name(project_name:str) -> str:
                 result = prefix + _suffix_map[site]
                 # Could return prefix as language
 
-    if result is None or result not in _databases:
+    if result is None or result not in known_databases():
         return None
 
     return result
+
+
+class ProjectFilter:
+    """Decides from the raw project field whether a log line is worth parsing.
+    
+    A project is accepted only if it maps to a known database (unless 
+    ``unmapped`` is set), and that database or the project name itself is 
+    in ``allow`` (if given) and not in ``deny``.
+    Decisions are cached per distinct project, so the per-line cost is a
+    single dictionary lookup.
+    
+    Example::
+        accept = ProjectFilter(deny=['commonswiki'])
+        accept(b'en.m')
+        # -> True
+    
+    Args:
+        allow: Optional iterable of project or database names to accept
+        deny: Optional iterable of project or database names to reject
+        unmapped: Also accept projects that do not map to a known database,
+            e.g. so that their titles can be kept for a later remapping
+    """
+    def __init__(self, allow=None, deny=None, unmapped=False):
+        self.allow = frozenset(allow) if allow else None
+        self.deny = frozenset(deny) if deny else frozenset()
+        self.unmapped = unmapped
+        self._cache = dict()
+        
+    def __call__(self, project:bytes) -> bool:
+        result = self._cache.get(project)
+        if result is None:
+            name = project.decode()
+            dbname = database_from_project_name(name)
+            names = { name, dbname }
+            result = (dbname is not None or self.unmapped) \
+                and (self.allow is None or not self.allow.isdisjoint(names)) \
+                and self.deny.isdisjoint(names)
+            self._cache[project] = result
+        return result
+    
+    def params(self):
+        """Returns JSON-serializable description, e.g. for checkpoints"""
+        return dict(allow=sorted(self.allow) if self.allow is not None else None,
+                    deny=sorted(self.deny), unmapped=self.unmapped)
     
 def _sitematrix_database_names(data):
     for k,v in data.items():
@@ -7,6 +7,42 @@ CREATE TABLE IF NOT EXISTS qid_hourly_views
     INDEX hour_qid (hour,qid)
 );
 
+CREATE TABLE IF NOT EXISTS hourly_top
+(
+    hour DATETIME NOT NULL,
+    qid INT NOT NULL,
+    views INT NOT NULL,
+    PRIMARY KEY (hour,qid)
+);
+
+CREATE TABLE IF NOT EXISTS hourly_unresolved
+(
+    hour DATETIME NOT NULL,
+    dbname VARBINARY(32) NOT NULL,
+    title_hash BINARY(16) NOT NULL,
+    title BLOB NOT NULL,
+    views INT NOT NULL,
+    error INT NOT NULL,
+    PRIMARY KEY (hour,dbname,title_hash)
+);
+
+CREATE TABLE IF NOT EXISTS hourly_sketch
+(
+    hour DATETIME NOT NULL PRIMARY KEY,
+    width INT NOT NULL,
+    depth INT NOT NULL,
+    counts MEDIUMBLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sketch_rollup
+(
+    period VARCHAR(10) NOT NULL PRIMARY KEY,
+    revision BINARY(32) NOT NULL,
+    width INT NOT NULL,
+    depth INT NOT NULL,
+    counts MEDIUMBLOB NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS hours (
     file VARCHAR(80) NOT NULL PRIMARY KEY,
     hour DATETIME NOT NULL UNIQUE KEY,
@@ -14,5 +50,6 @@ CREATE TABLE IF NOT EXISTS hours (
     duration INT NOT NULL,
     views INT NOT NULL,
     max_qid INT NOT NULL,
-    n_qids INT NOT NULL
-);
\ No newline at end of file
+    n_qids INT NOT NULL,
+    remapped BOOLEAN NOT NULL DEFAULT FALSE
+);
@@ -0,0 +1,272 @@
+"""Bounded-memory summaries of weighted streams.
+
+A ``SpaceSaving`` summary tracks the heaviest keys of a stream (e.g. the most
+viewed unresolved titles) using a fixed number of counters.  Each reported
+count is an upper bound on the true total, and ``count - error`` is a lower
+bound.  Any key whose true total exceeds ``total / capacity`` is guaranteed
+to be present.  Summaries of different hours can be merged with the same
+guarantees.
+
+A ``CountMinSketch`` estimates the views of any QID from a fixed-size table
+of counters.  Estimates never undercount, and overcount by more than
+``epsilon`` times the total views with probability at most ``delta``.
+Sketches of different hours are merged by adding their tables.
+
+The default width is the smallest power of two with ``epsilon`` at most
+``DEFAULT_SKETCH_EPSILON``: 2**17 counters, so ``epsilon`` is about 2.1e-5.
+With about 2e7 views in an hour, the bound is then about 400 views for an
+hour, 10,000 for a day, and 300,000 for 30 days, each holding with
+probability 1 - exp(-4) (98%) at the default depth.  The bound grows with
+the window because it is relative to the window's total views; conservative
+update keeps typical errors well below it.
+
+Example::
+    sketch = SpaceSaving(1000)
+    sketch.add(('enwiki', 'Douglas_Adams'), 42)
+    sketch.top(10)
+    # -> [(('enwiki', 'Douglas_Adams'), 42, 0)]
+"""
+
+import heapq
+import math
+import zlib
+
+import numpy as np
+
+from .constants import DEFAULT_SKETCH_EPSILON, DEFAULT_SKETCH_DEPTH
+
+
+class SpaceSaving:
+    """Space-Saving summary of the heaviest keys in a weighted stream
+
+    Counters are indexed by count in a min-heap with lazy deletion, so each
+    update takes logarithmic time.
+
+    Args:
+        capacity: Maximum number of keys to track
+    """
+    __slots__ = ('capacity', 'counters', 'heap', 'total')
+
+    def __init__(self, capacity):
+        assert capacity > 0, "capacity must be positive"
+        self.capacity = capacity
+        self.counters = dict() # key -> [count, error]
+        self.heap = [] # (count, key), possibly stale
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counters)
+
+    def _pop_min(self):
+        """Remove and return (key, count) for the smallest counter"""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            counter = self.counters.get(key)
+            if counter is not None and counter[0] == count:
+                del self.counters[key]
+                return (key, count)
+
+    def add(self, key, weight=1):
+        """Count ``weight`` more occurrences of ``key``"""
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            counter = self.counters[key] = [weight, 0]
+        else:
+            # Replace the smallest counter, inheriting its count as error
+            _, minimum = self._pop_min()
+            counter = self.counters[key] = [minimum + weight, minimum]
+        heapq.heappush(self.heap, (counter[0], key))
+        if len(self.heap) > 4 * len(self.counters) + 64:
+            self.heap = [ (count, key) for key, (count, _) in self.counters.items() ]
+            heapq.heapify(self.heap)
+
+    def minimum(self):
+        """Upper bound on the count of any key not tracked"""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counters.values())
+
+    def top(self, n=None):
+        """Returns the heaviest keys
+
+        Args:
+            n: Number of keys to return (default all)
+
+        Returns:
+            items: List of (key, count, error) triples in descending order of count
+        """
+        items = sorted(((key, count, error) for key, (count, error) in self.counters.items()),
+                       key=lambda x: (-x[1], x[2]))
+        return items if n is None else items[:n]
+
+    @classmethod
+    def from_items(cls, items, capacity=None):
+        """Rebuild a summary from (key, count, error) triples, as from ``top``
+
+        If ``capacity`` is not given, the summary is assumed to be full, so
+        that untracked keys are bounded by the smallest count.  Otherwise,
+        fewer items than ``capacity`` means that no key was ever evicted,
+        so untracked keys have a count of 0.
+        """
+        items = list(items)
+        result = cls(max(capacity or 0, len(items), 1))
+        for key, count, error in items:
+            result.counters[key] = [count, error]
+            result.total += count - error
+        result.heap = [ (count, key) for key, count, _ in items ]
+        heapq.heapify(result.heap)
+        return result
+
+    def merge(self, other):
+        """Returns a new summary of both streams, with the larger capacity
+
+        A key missing from one summary is charged that summary's ``minimum``,
+        both as count and error, so the bounds still hold.
+        """
+        min_self, min_other = self.minimum(), other.minimum()
+        merged = dict()
+        for key in self.counters.keys() | other.counters.keys():
+            count_a, error_a = self.counters.get(key, (min_self, min_self))
+            count_b, error_b = other.counters.get(key, (min_other, min_other))
+            merged[key] = (count_a + count_b, error_a + error_b)
+        capacity = max(self.capacity, other.capacity)
+        top = heapq.nlargest(capacity, merged.items(), key=lambda x: x[1][0])
+        result = SpaceSaving.from_items(((key, count, error) for key, (count, error) in top),
+                                        capacity)
+        result.total = self.total + other.total
+        return result
+
+
+# Odd multipliers for multiply-shift hashing, one per row.  These are fixed
+# (rather than drawn from a seeded generator, whose output may change between
+# NumPy versions) because sketches saved with them must remain comparable.
+_MULTIPLIERS = np.array([
+    0x6bf3ade37945a05f, 0x94d64b6a2d01f795, 0x88098340f096f65b, 0xdb59cf42ac028711,
+    0x79ac48cf4b719741, 0x3a3f74e716e010f3, 0x6159a0dcc856c64b, 0x07247d7afdc8d067,
+    0x45e9a7e98ae8aebb, 0xdab04940eaa703e7, 0x0636dfe45a5ad18d, 0x9a43d5dc41faba73,
+    0xe3639956dfbad5eb, 0x852523a4c40abd03, 0xb6f8b73d092f12d7, 0xe016f795f6c358d9,
+    0x4c0031830d8b4b13, 0xe4cf0b6a518f639d, 0x25122af9decb32a5, 0xff853364d0f2db2b,
+    0xc13d4b44089f5fab, 0x703c6c89c1652ba5, 0xa793e39abb64729d, 0x6aa2bfaaecf4ff9b,
+    0x17558c844c73d58f, 0xe57e854483921265, 0x81f51c76c3159533, 0xd3abc29bbd7fc8a1,
+    0x9d3b5a52c3da0411, 0x371d8292c367abb9, 0x26f14e824d517101, 0x1461def0da66e667,
+], dtype=np.uint64)
+
+
+def sketch_width(epsilon):
+    """Smallest power of two width whose ``epsilon`` (e/width) is at most ``epsilon``"""
+    assert 0 < epsilon < 1, "epsilon must be between 0 and 1"
+    return 1 << max(0, math.ceil(math.log2(math.e / epsilon)))
+
+
+DEFAULT_SKETCH_WIDTH = sketch_width(DEFAULT_SKETCH_EPSILON)
+
+
+class CountMinSketch:
+    """Count-Min sketch of views by QID, with conservative update
+
+    With ``width`` counters per row and ``depth`` rows, each estimate is at
+    least the true count, and exceeds it by more than ``epsilon`` (e/width)
+    times the total count with probability at most ``delta`` (exp(-depth)).
+    Conservative update only increments counters as far as is needed, which
+    keeps estimates tighter than these bounds in practice.
+
+    Args:
+        width: Number of counters per row (a power of two)
+        depth: Number of rows
+        counts: Optional existing table of counters
+    """
+    __slots__ = ('counts',)
+
+    def __init__(self, width=DEFAULT_SKETCH_WIDTH, depth=DEFAULT_SKETCH_DEPTH, counts=None):
+        assert width > 0 and width & (width - 1) == 0, "width must be a power of two"
+        assert 0 < depth <= len(_MULTIPLIERS), f"depth must be at most {len(_MULTIPLIERS)}"
+        if counts is None:
+            counts = np.zeros((depth, width), dtype=np.uint64)
+        assert counts.shape == (depth, width)
+        self.counts = counts
+
+    @property
+    def depth(self):
+        return self.counts.shape[0]
+
+    @property
+    def width(self):
+        return self.counts.shape[1]
+
+    @property
+    def epsilon(self):
+        """Bound on overcounting as a fraction of the total count"""
+        return math.e / self.width
+
+    @property
+    def delta(self):
+        """Probability that an estimate exceeds the ``epsilon`` bound"""
+        return math.exp(-self.depth)
+
+    def _buckets(self, keys):
+        """Returns a (depth, len(keys)) array of counter indexes"""
+        keys = np.asarray(keys, dtype=np.uint64)
+        shift = np.uint64(64 - (self.width.bit_length() - 1))
+        return (_MULTIPLIERS[:self.depth, None] * keys[None, :]) >> shift
+
+    def update(self, keys, weights, block_size=1<<16):
+        """Add weights for distinct keys
+
+        Keys are processed in blocks, each counter being raised to at least
+        the block's prior estimate plus the new weight.  This may be slightly
+        looser than strictly sequential updates, but never undercounts.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        weights = np.asarray(weights, dtype=np.uint64)
+        rows = np.arange(self.depth)[:, None]
+        for i in range(0, len(keys), block_size):
+            buckets = self._buckets(keys[i:i+block_size])
+            targets = self.counts[rows, buckets].min(axis=0) + weights[i:i+block_size]
+            for row in range(self.depth):
+                np.maximum.at(self.counts[row], buckets[row], targets)
+
+    def estimate(self, keys):
+        """Returns estimated counts for an array of keys"""
+        buckets = self._buckets(keys)
+        return self.counts[np.arange(self.depth)[:, None], buckets].min(axis=0)
+
+    def fold(self, width, depth=None):
+        """Returns the sketch as it would have been with fewer counters or rows
+
+        As buckets are the top bits of each hash, halving the width adds
+        pairs of neighbouring counters.  Estimates still never undercount.
+        """
+        depth = self.depth if depth is None else depth
+        assert width <= self.width and depth <= self.depth, "Can only fold to a smaller sketch"
+        counts = self.counts[:depth]
+        counts = counts.reshape((depth, width, self.width // width)).sum(axis=2, dtype=np.uint64)
+        return CountMinSketch(width, depth, counts)
+
+    def merge(self, other):
+        """Returns a new sketch of both streams
+
+        Sketches of different shapes (e.g. from before a change to the
+        default width) are first folded to the smaller shape.
+        """
+        width, depth = min(self.width, other.width), min(self.depth, other.depth)
+        a, b = self.fold(width, depth), other.fold(width, depth)
+        return CountMinSketch(width, depth, a.counts + b.counts)
+
+    def to_bytes(self):
+        """Returns the compressed table of counters
+
+        Counters are stored in 32 bits when they fit, as they do for an hour.
+        """
+        dtype = '<u4' if self.counts.max(initial=0) < (1 << 32) else '<u8'
+        return zlib.compress(self.counts.astype(dtype).tobytes())
+
+    @classmethod
+    def from_bytes(cls, data, width, depth):
+        """Rebuild a sketch from ``to_bytes``"""
+        data = zlib.decompress(data)
+        dtype = '<u4' if len(data) == 4 * width * depth else '<u8'
+        counts = np.frombuffer(data, dtype=dtype).astype(np.uint64)
+        return cls(width, depth, counts.reshape((depth, width)))
@@ -0,0 +1,155 @@
+"""Bulk export of hourly views for a list of QIDs.
+
+Rather than querying ``qid_hourly_views`` one QID at a time, QIDs are
+sorted and looked up in chunks, so that each query is a set of range scans
+on the ``(qid,hour)`` primary key.  The result is a dense QID × hour matrix.
+
+Example::
+    summary, qids, hours, views = get_timeseries([42, 64], start='30d')
+    views[list(qids).index(42)]
+    # -> array of views of Q42 for each hour
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+from pathlib import Path
+from textwrap import dedent
+
+import numpy as np
+
+from .constants import *
+from .archive import Archive
+from .dump import open_source, convert_start_and_end, get_hours, datetime_as_mysql
+from .util import chunks
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def series_by_qid(cursor, qids, hours, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Streams hourly views for each QID
+
+    Args:
+        cursor: Database cursor or ``Archive``
+        qids: Sorted array of distinct QIDs
+        hours: Sorted list of hours like "2018-10-10 01:00:00"
+        chunk_size: Number of QIDs to look up in each query
+
+    Yields:
+        qids: Chunk of QIDs
+        views: Matrix of views with a row for each QID and a column for each hour
+    """
+    if not hours or isinstance(cursor, Archive):
+        yield (qids, cursor.series(qids, hours) if hours
+               else np.zeros((len(qids), 0), dtype=np.uint32))
+        return
+    logger = logging.getLogger(__name__)
+    columns = { hour: j for j, hour in enumerate(hours) }
+    for chunk in chunks(qids.tolist(), chunk_size):
+        chunk = np.fromiter(chunk, dtype=np.int64)
+        views = np.zeros((len(chunk), len(hours)), dtype=np.uint32)
+        sql = dedent(f"""
+            SELECT qid, hour, views
+            FROM qid_hourly_views
+            WHERE qid IN ({','.join(str(qid) for qid in chunk.tolist())})
+            AND hour >= '{hours[0]}'
+            AND hour <= '{hours[-1]}';
+        """)
+        logger.debug(sql)
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+        rows_qids = np.fromiter((qid for qid, _, _ in rows), dtype=np.int64, count=len(rows))
+        rows_hours = np.fromiter((columns.get(datetime_as_mysql(hour), -1) for _, hour, _ in rows),
+                                 dtype=np.int64, count=len(rows))
+        rows_views = np.fromiter((v for _, _, v in rows), dtype=np.int64, count=len(rows))
+        found = rows_hours >= 0
+        views[np.searchsorted(chunk, rows_qids[found]), rows_hours[found]] = rows_views[found]
+        yield (chunk, views)
+
+
+def get_timeseries(qids, database=DEFAULT_DATABASE, start=None, end=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """Returns hourly views for a list of QIDs
+
+    Args:
+        qids: Iterable of integer QIDs
+        database: name of database to use, or ``archive:DIR`` for a columnar archive
+        start: Start hour as "2018-10-10T01" or a duration like "1d"
+        end: End hour as "2018-10-10T01" or None
+        chunk_size: Number of QIDs to look up in each query
+
+    Returns:
+        summary: Dictionary of summary information
+        qids: Sorted array of distinct QIDs
+        hours: List of available hours in the range, like "2018-10-10 01:00:00"
+        views: ``uint32`` matrix with a row for each QID and a column for each hour
+    """
+    logger = logging.getLogger(__name__)
+    qids = np.unique(np.fromiter(qids, dtype=np.int64))
+    with open_source(database) as cursor:
+        (start, end) = convert_start_and_end(cursor, start, end)
+        hours = sorted(get_hours(cursor, start, end))
+        logger.info(f"{len(qids)} QIDs over {len(hours)} hours from {start} to {end}")
+        parts = list(series_by_qid(cursor, qids, hours, chunk_size))
+    views = np.concatenate([ part for _, part in parts ]) if parts \
+        else np.zeros((0, len(hours)), dtype=np.uint32)
+    summary = dict(start=start, end=end, n_qids=len(qids), n_hours=len(hours))
+    return (summary, qids, hours, views)
+
+
+def write_timeseries(output, summary, qids, hours, views):
+    """Write typed arrays and JSON summary to a compressed ``.npz`` file"""
+    with open(output, 'wb') as f:
+        np.savez_compressed(f, summary=np.array(json.dumps(summary)),
+                            qids=qids.astype(np.uint32), hours=np.array(hours, dtype='U19'),
+                            views=views)
+
+
+QID_RE = re.compile(r'^Q?(\d+)$', re.IGNORECASE)
+
+def read_qids(f):
+    """Reads QIDs like "Q42" or "42", one per line, ignoring anything else"""
+    for line in f:
+        m = QID_RE.search(line.strip())
+        if m:
+            yield int(m.group(1))
+
+
+def parse_args(argv=None):
+    """Wrapper for argparse.ArgumentParser()"""
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Increases log level to INFO')
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Increases log level to DEBUG')
+    parser.add_argument('qids', type=argparse.FileType('r'),
+                        help="File of QIDs, one per line, or - for standard input")
+    parser.add_argument('--database', '--db', help='database name', default=DEFAULT_DATABASE)
+    parser.add_argument('--start', help='Start time, e.g. 2018-10-10T17 or 30d')
+    parser.add_argument('--end', help="End time, e.g. 2018-10-10T17")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of QIDs to look up in each query")
+    parser.add_argument('-o', '--output', type=Path, required=True,
+                        help="Compressed .npz file to write to")
+    logger = logging.getLogger(__name__)
+    args = parser.parse_args(argv)
+    log_level = logging.DEBUG if args.debug else logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig()
+    logger.setLevel(log_level)
+    logger.info(argv)
+    logger.info(args)
+    return args
+
+
+def main(argv=None):
+    """Operate from a command-line"""
+    args = parse_args(argv)
+    with args.qids as f:
+        qids = list(read_qids(f))
+    result = get_timeseries(qids, database=args.database, start=args.start, end=args.end,
+                            chunk_size=args.chunk_size)
+    write_timeseries(args.output, *result)
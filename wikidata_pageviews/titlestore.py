@@ -0,0 +1,232 @@
+"""Title-level intermediate results, so that hours can be remapped to QIDs
+without re-reading the logs.
+
+The store directory holds:
+    * ``titles.sqlite``: Title dictionary, assigning each title an id within
+      its project (as named in the logs, e.g. ``en.m``) that is shared by
+      every hour
+    * ``hours/pageviews-YYYYMMDD-HH0000.npz``: For each hour, the title ids and
+      views for each project, and the views of lines that were filtered out
+
+Titles are kept by project, not by database, so that remapping applies the
+current ``database_from_project_name``, including to projects that could
+not be mapped when the hour was first processed.
+
+The dictionary is an on-disk index, so only the titles of the batch at hand
+are looked up, rather than every title ever seen being loaded.  New ids are
+assigned in a SQLite write transaction, which also serializes concurrent
+runs sharing the store.  Dictionaries in the ``titles/PROJECT.txt`` files
+of older stores are imported when the store is opened.  Titles are committed before any hour that refers
+to them is written, so an interrupted run leaves at most some unused titles.
+
+Example::
+    store = TitleStore('/data/wdpv-titles')
+    recorder = store.recorder()
+    for project, titles in recorder.record(partition_by_project(read_log(file))):
+        ...
+    recorder.save(file.name)
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from array import array
+from pathlib import Path
+
+import numpy as np
+
+from .batch import TitleBatch
+from .util import chunks
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS titles (
+    project TEXT NOT NULL,
+    title BLOB NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (project, title)
+) WITHOUT ROWID;
+
+CREATE UNIQUE INDEX IF NOT EXISTS project_id ON titles (project, id);
+"""
+
+QUERY_SIZE = 500 # Number of titles or ids looked up per query
+
+
+class TitleStore:
+    """Directory of per-hour title views sharing a title dictionary per project
+
+    Args:
+        path: Store directory
+        timeout: Seconds to wait for another process adding titles
+    """
+    def __init__(self, path, timeout=600):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock() # The connection is shared between threads
+        self._conn = sqlite3.connect(self.path / 'titles.sqlite', timeout=timeout,
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL") # Lookups proceed while others add
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._import_dictionaries()
+
+    def _import_dictionaries(self):
+        """Load any ``titles/PROJECT.txt`` dictionaries of older stores, keeping their ids"""
+        for file in sorted((self.path / 'titles').glob('*.txt')):
+            project = file.stem
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM titles WHERE project = ? LIMIT 1",
+                                      (project,)).fetchone() is None:
+                    with open(file, 'rb') as f:
+                        self._conn.executemany("INSERT INTO titles (project, title, id) "
+                                               "VALUES (?, ?, ?)",
+                                               ((project, title[:-1], i) for i, title in enumerate(f)))
+                    logging.getLogger(__name__).info(f"Imported title dictionary {file}")
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        self._conn.close()
+
+    def hour_file(self, filename):
+        """Path of the intermediate for a log file like ``pageviews-20181021-120000.gz``"""
+        return self.path / 'hours' / (Path(filename).stem + '.npz')
+
+    def _lookup(self, project, titles):
+        """Returns dictionary of ids for those of some titles that have one"""
+        results = dict()
+        for chunk in map(list, chunks(titles, QUERY_SIZE)):
+            placeholders = ", ".join(["?"] * len(chunk))
+            results.update(self._conn.execute(
+                f"SELECT title, id FROM titles WHERE project = ? AND title IN ({placeholders})",
+                [project, *chunk]))
+        return results
+
+    def add(self, project, titles:TitleBatch) -> array:
+        """Returns store ids for a batch of titles, assigning new ids as needed"""
+        buffer = bytes(titles.buffer)
+        offsets = titles.offsets
+        batch = [ buffer[offsets[i]:offsets[i+1]] for i in range(len(titles)) ]
+        distinct = list(dict.fromkeys(batch))
+        with self._lock:
+            ids = self._lookup(project, distinct)
+            new = [ title for title in distinct if title not in ids ]
+            if new:
+                # Takes the write lock, so ids are assigned by one process at a time
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    ids.update(self._lookup(project, new)) # Perhaps added meanwhile
+                    new = [ title for title in new if title not in ids ]
+                    (last,) = self._conn.execute("SELECT MAX(id) FROM titles WHERE project = ?",
+                                                 (project,)).fetchone()
+                    first = 0 if last is None else last + 1
+                    rows = [ (project, title, first + i) for i, title in enumerate(new) ]
+                    self._conn.executemany("INSERT INTO titles (project, title, id) "
+                                           "VALUES (?, ?, ?)", rows)
+                    self._conn.execute("COMMIT")
+                except:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                ids.update((title, title_id) for _, title, title_id in rows)
+        return array('I', (ids[title] for title in batch))
+
+    def titles(self, project, ids):
+        """Returns the titles (decoded) with the given ids"""
+        by_id = dict()
+        with self._lock:
+            for chunk in map(list, chunks(dict.fromkeys(ids), QUERY_SIZE)):
+                placeholders = ", ".join(["?"] * len(chunk))
+                by_id.update(self._conn.execute(
+                    f"SELECT id, title FROM titles WHERE project = ? AND id IN ({placeholders})",
+                    [project, *chunk]))
+        return [ by_id[i].decode() for i in ids ]
+
+    def write_hour(self, filename, entries, filtered_views=0):
+        """Save one hour's title views
+
+        Args:
+            filename: Name of log file processed
+            entries: Dictionary from project name to parallel (ids, views) arrays of store ids
+            filtered_views: Views of lines that were filtered out before parsing
+        """
+        projects = sorted(entries)
+        meta = dict(file=filename, projects=projects, filtered_views=filtered_views)
+
+        def column(i):
+            """Concatenate ids (0) or views (1) across projects"""
+            return np.concatenate([ np.asarray(entries[project][i], dtype=np.uint32)
+                                   for project in projects ] + [ np.zeros(0, dtype=np.uint32) ])
+
+        file = self.hour_file(filename)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_name(file.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, meta=np.array(json.dumps(meta)),
+                                counts=np.array([ len(entries[project][0])
+                                                  for project in projects ], dtype=np.int64),
+                                ids=column(0), views=column(1))
+        os.replace(tmp, file)
+        logging.getLogger(__name__).info(f"Saved title views for {filename} to {file}")
+
+    def read_hour(self, file):
+        """Load one hour's title views
+
+        Returns:
+            filename: Name of log file processed
+            entries: Dictionary from project name to parallel (ids, views) arrays
+            filtered_views: Views of lines that were filtered out before parsing
+        """
+        with np.load(file) as data:
+            meta = json.loads(str(data['meta']))
+            ends = np.cumsum(data['counts'])
+            ids = np.split(data['ids'], ends[:-1]) if len(ends) else []
+            views = np.split(data['views'], ends[:-1]) if len(ends) else []
+        entries = { project: (ids[i], views[i]) for i, project in enumerate(meta['projects']) }
+        return (meta['file'], entries, meta['filtered_views'])
+
+    def hour_files(self):
+        """Returns sorted list of saved hours"""
+        return sorted((self.path / 'hours').glob('pageviews-*.npz'))
+
+    def has_hour(self, filename):
+        return self.hour_file(filename).exists()
+
+    def recorder(self):
+        """Returns an ``HourRecorder`` for one hour's (project, titles) pairs"""
+        return HourRecorder(self)
+
+
+class HourRecorder:
+    """Collects one hour's title views as they stream past
+
+    Args:
+        store: ``TitleStore`` to save to
+    """
+    def __init__(self, store):
+        self.store = store
+        self.entries = dict()
+        self.filtered_views = 0
+
+    def record(self, partitions):
+        """Passes (project, titles) pairs through unchanged, recording each
+
+        The project is None for the counts of filtered lines, as from
+        ``partition_by_project``.
+        """
+        for project, titles in partitions:
+            if project is None:
+                self.filtered_views += titles.total_views()
+            else:
+                ids, views = self.entries.setdefault(project, (array('I'), array('I')))
+                ids.extend(self.store.add(project, titles))
+                views.extend(titles.views)
+            yield (project, titles)
+
+    def save(self, filename):
+        """Write the recorded hour to the store"""
+        self.store.write_hour(filename, self.entries, self.filtered_views)
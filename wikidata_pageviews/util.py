@@ -4,12 +4,15 @@ Various generic functions that we require.
 
 from typing import Iterable, Generator, Tuple, Optional
 import itertools
+import heapq
+import sys
+import queue
+import threading
 import tempfile
 from textwrap import dedent
-from collections import defaultdict
 
 def chunk_and_partition(items, key, chunk_size=None, max_unprocessed=None, 
-                        max_buckets=None):
+                        max_buckets=None, size=None, max_bytes=None, sizeof=None):
     """Partitions items and processes in chunks
     
     Suppose you have an iterable of items that you want to process in chunks, 
@@ -21,6 +24,7 @@ def chunk_and_partition(items, key, chunk_size=None, max_unprocessed=None,
         * A bucket (necessarily the largest) reaches ``chunk_size``
         * The total number of unprocessed items reaches ``max_unprocessed``
         * The total number of buckets would exceed ``max_buckets``
+        * The total size in bytes of unprocessed items reaches ``max_bytes``
     After the input has been exhausted, remaining items are yielded in arbitrary order.
 
     Chunking will work well if the input has large run-lengths by partition key
@@ -30,8 +34,17 @@ def chunk_and_partition(items, key, chunk_size=None, max_unprocessed=None,
     to the number of distinct partition keys;
     otherwise the actual chunk size will tend to be smaller than ``chunk_size``.
     
-    If none of ``chunk_size``, ``max_unprocessed`, and ``max_buckets`` is specified,
-    then the entire input list will be partitioned before processing (cf ``itertools.groupby``)
+    If none of ``chunk_size``, ``max_unprocessed`, ``max_buckets`` and ``max_bytes`` 
+    is specified, then the entire input list will be partitioned before processing 
+    (cf ``itertools.groupby``)
+
+    If ``size`` is given, items are weighted by it when comparing against
+    ``chunk_size`` and ``max_unprocessed`` (e.g. when each item is itself a batch),
+    and those limits are treated as thresholds rather than exact counts.
+    
+    Buckets are indexed by size in a heap with lazy deletion, so finding the
+    largest bucket takes logarithmic rather than linear time, and large numbers
+    of buckets are practical.
     
     Args:
         items: Iterable of items to process
@@ -39,6 +52,10 @@ def chunk_and_partition(items, key, chunk_size=None, max_unprocessed=None,
         chunk_size: Maximum number of items per chunk 
         max_unprocessed: Maximum number of items to hold unprocessed
         max_buckets: Maximum number of buckets
+        size: Optional function that takes an item and returns its weight (default 1)
+        max_bytes: Maximum number of bytes to hold unprocessed
+        sizeof: Function that takes an item and returns its size in bytes 
+            (default ``sys.getsizeof``)
         
     Yields:
         partition: Result of ``key``
@@ -55,34 +72,70 @@ def chunk_and_partition(items, key, chunk_size=None, max_unprocessed=None,
     check_optional_positive_integer(chunk_size, "chunk_size")
     check_optional_positive_integer(max_unprocessed, "max_unprocessed")
     check_optional_positive_integer(max_buckets, "max_buckets")
+    check_optional_positive_integer(max_bytes, "max_bytes")
+    if sizeof is None:
+        sizeof = sys.getsizeof
+    
+    cache = dict()
+    weights = dict() # Total weight of each list in cache
+    n_bytes = dict() # Total size of each list in cache
+    orders = dict() # Order in which each bucket was created, to break ties
+    heap = [] # Entries of (-weight, order, partition), possibly stale
+    n_created = 0
+    n_unprocessed = 0 # Total weight of lists in cache
+    bytes_unprocessed = 0 # Total size of lists in cache
     
-    cache = defaultdict(list)
-    n_unprocessed = 0 # Total length of lists in cache
+    def remove(p):
+        """Removes and returns bucket from cache."""
+        nonlocal n_unprocessed, bytes_unprocessed
+        n_unprocessed -= weights.pop(p)
+        bytes_unprocessed -= n_bytes.pop(p)
+        del orders[p]
+        return (p, cache.pop(p))
     
     def pop_largest():
         """Removes and returns largest bucket from cache."""
-        nonlocal cache, n_unprocessed
-        p, ii = max(cache.items(), key=lambda p_ii: len(p_ii[1]))
-        del cache[p]
-        n_unprocessed -= len(ii)
-        return (p, ii)
+        while True:
+            negative_weight, order, p = heapq.heappop(heap)
+            # Skip entries for buckets that have since grown or been removed
+            if orders.get(p) == order and weights[p] == -negative_weight:
+                return remove(p)
     
     for item in items:
         partition = key(item)
-        if max_buckets is not None and len(cache) == max_buckets and partition not in cache:
-            yield pop_largest()
+        if partition not in cache:
+            if max_buckets is not None and len(cache) == max_buckets:
+                yield pop_largest()
+            cache[partition] = []
+            weights[partition] = 0
+            n_bytes[partition] = 0
+            orders[partition] = n_created
+            n_created += 1
+        weight = 1 if size is None else size(item)
         cache[partition].append(item)
-        n_unprocessed += 1
-        if chunk_size is not None and len(cache[partition]) == chunk_size:
+        weights[partition] += weight
+        n_unprocessed += weight
+        if max_bytes is not None:
+            item_bytes = sizeof(item)
+            n_bytes[partition] += item_bytes
+            bytes_unprocessed += item_bytes
+        if chunk_size is not None and weights[partition] >= chunk_size:
             # we already know which one is largest
-            yield (partition, cache[partition])
-            del cache[partition]
-            n_unprocessed -= chunk_size
-        elif max_unprocessed is not None and n_unprocessed == max_unprocessed:
+            yield remove(partition)
+            continue
+        heapq.heappush(heap, (-weights[partition], orders[partition], partition))
+        if len(heap) > 4 * len(cache) + 64:
+            # Discard stale entries
+            heap = [ (-weights[p], orders[p], p) for p in cache ]
+            heapq.heapify(heap)
+        if max_unprocessed is not None and n_unprocessed >= max_unprocessed:
+            yield pop_largest()
+        elif max_bytes is not None and bytes_unprocessed >= max_bytes:
             yield pop_largest()
         # At this point:
         # * The maximum length is less than chunk_size
         # * The total length is less than max_unprocessed
+        # * The total size is less than max_bytes
 
     # Now process the remaining items in arbitrary order
     for p, ii in cache.items():
@@ -176,6 +229,95 @@ def batch_insert(cursor, table:str, data: Iterable[Iterable],
     return result
 
 
+def pipelined_map(f, items, workers=1, max_pending=None):
+    """Apply a function to items in worker threads, overlapping with the
+    production of the items themselves.
+    
+    The input iterable is consumed in its own thread, so (for example) parsing
+    can continue while workers wait on the network.  Bounded queues between
+    the stages provide backpressure.  The first exception raised by the input
+    iterable or by ``f`` is re-raised in the caller, and all threads are
+    stopped.  Closing the returned generator also stops all threads.
+    
+    If ``workers`` is zero, this is equivalent to ``map(f, items)``.
+    
+    Args:
+        f: Function to apply to each item
+        items: Iterable of inputs
+        workers: Number of threads applying ``f``
+        max_pending: Maximum number of items waiting in each queue
+            (default twice the number of workers)
+        
+    Yields:
+        result: Result of ``f`` for each item, in order of completion
+    """
+    if workers == 0:
+        yield from map(f, items)
+        return
+    if max_pending is None:
+        max_pending = 2 * workers
+    inputs = queue.Queue(max_pending)
+    outputs = queue.Queue(max_pending)
+    stop = threading.Event()
+    done = object() # Sentinel
+    
+    def put(q, x):
+        """Put onto queue, giving up if the pipeline is stopped"""
+        while not stop.is_set():
+            try:
+                q.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for item in items:
+                if not put(inputs, item):
+                    return
+        except BaseException as e:
+            put(outputs, (False, e))
+        finally:
+            for _ in range(workers):
+                put(inputs, done)
+    
+    def work():
+        while not stop.is_set():
+            try:
+                item = inputs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is done:
+                put(outputs, done)
+                return
+            try:
+                result = (True, f(item))
+            except BaseException as e:
+                result = (False, e)
+            put(outputs, result)
+    
+    threads = [ threading.Thread(target=produce, daemon=True) ]
+    threads += [ threading.Thread(target=work, daemon=True) for _ in range(workers) ]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = workers
+        while remaining:
+            x = outputs.get()
+            if x is done:
+                remaining -= 1
+                continue
+            ok, value = x
+            if not ok:
+                raise value
+            yield value
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
 def iterate_until_n_succeed(f, data, n):
     """Map a boolean-valued function down an iterable until 
     the number of True results reaches some threshold,
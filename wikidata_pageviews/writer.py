@@ -0,0 +1,343 @@
+"""Interchangeable backends for bulk-writing hourly results.
+
+Each backend writes the ``qid_hourly_views`` rows for one hour, in primary
+key order and in chunks, followed by the hour's heavy hitters (its most
+viewed QIDs) in ``hourly_top``, a sketch of its most viewed unresolved titles
+in ``hourly_unresolved``, a Count-Min sketch of its views in ``hourly_sketch``,
+and then the ``hours`` row, all in a single transaction.
+
+Database names of the form ``sqlite:PATH`` refer to a local SQLite file,
+which allows the pipeline to be run and tested without Toolforge.
+Names of the form ``archive:DIR`` refer to a directory of columnar hourly
+files (see ``archive``).
+
+Example::
+    writer = get_writer('sqlite:/tmp/wdpv.db')
+    writer.write_hour('pageviews-20181021-120000.gz', '2018-10-21T12:00:00',
+                      [(42, 100)], time.time())
+"""
+
+import hashlib
+import heapq
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+from textwrap import dedent
+
+from .util import batch_insert, chunks
+from .constants import DEFAULT_TOP_N
+
+SQLITE_PREFIX = 'sqlite:'
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS qid_hourly_views
+(
+    qid INT NOT NULL,
+    hour DATETIME NOT NULL,
+    views INT NOT NULL,
+    PRIMARY KEY (qid,hour)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS hour_qid ON qid_hourly_views (hour,qid);
+
+CREATE TABLE IF NOT EXISTS hourly_top (
+    hour DATETIME NOT NULL,
+    qid INT NOT NULL,
+    views INT NOT NULL,
+    PRIMARY KEY (hour,qid)
+);
+
+CREATE TABLE IF NOT EXISTS hourly_unresolved (
+    hour DATETIME NOT NULL,
+    dbname VARBINARY(32) NOT NULL,
+    title_hash BINARY(16) NOT NULL,
+    title BLOB NOT NULL,
+    views INT NOT NULL,
+    error INT NOT NULL,
+    PRIMARY KEY (hour,dbname,title_hash)
+);
+
+CREATE TABLE IF NOT EXISTS hourly_sketch (
+    hour DATETIME NOT NULL PRIMARY KEY,
+    width INT NOT NULL,
+    depth INT NOT NULL,
+    counts BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS sketch_rollup (
+    period VARCHAR(10) NOT NULL PRIMARY KEY,
+    revision BINARY(32) NOT NULL,
+    width INT NOT NULL,
+    depth INT NOT NULL,
+    counts BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS hours (
+    file VARCHAR(80) NOT NULL PRIMARY KEY,
+    hour DATETIME NOT NULL UNIQUE,
+    processed DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    duration INT NOT NULL,
+    views INT NOT NULL,
+    max_qid INT NOT NULL,
+    n_qids INT NOT NULL,
+    remapped INT NOT NULL DEFAULT 0
+);
+"""
+
+
+def is_sqlite(database):
+    """Returns true iff the database name refers to a local SQLite file"""
+    return database.startswith(SQLITE_PREFIX)
+
+
+def sqlite_path(database):
+    """Returns path for a database name like ``sqlite:PATH``"""
+    assert is_sqlite(database), f"Expected a database name like {SQLITE_PREFIX}PATH: {database}"
+    return database[len(SQLITE_PREFIX):]
+
+
+@contextmanager
+def _sqlite_cursor(path):
+    """Cursor on a SQLite database, committed on success"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript(SQLITE_SCHEMA)
+        yield conn.cursor()
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def connect(database, **kargs):
+    """Open our own (not replica) database.
+
+    As with ``toolforge.connect``, the result should be used as a context
+    manager that provides a cursor.
+
+    Args:
+        database: Database name, or ``sqlite:PATH``
+        **kargs: Keyword arguments to pass down e.g. ``local_infile=1``
+    """
+    if is_sqlite(database):
+        return _sqlite_cursor(sqlite_path(database))
+    import toolforge # Only needed, and slow to import, for MariaDB
+    return toolforge.connect(database, cluster="tools", **kargs)
+
+
+def sql_hour(hour):
+    """Convert hour like "2018-10-21T12:00:00" into "2018-10-21 12:00:00"
+
+    MariaDB accepts either, but SQLite compares them as strings.
+    """
+    return hour.replace('T', ' ')
+
+
+def utc_timestamp():
+    """Current UTC time like "2018-10-21 12:34:56", as recorded in ``hours.processed``"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+def title_hash(title:bytes) -> bytes:
+    """Key for an unresolved title, which may be long and may differ from others only by case"""
+    return hashlib.md5(title).digest()
+
+
+def heavy_hitters(data, n):
+    """Returns the ``n`` most viewed (qid, views) pairs, excluding QID 0"""
+    return heapq.nlargest(n, (x for x in data if x[0] != 0), key=lambda x: x[1])
+
+
+def hour_sketch(data):
+    """Returns a ``CountMinSketch`` of (qid, views) pairs, excluding QID 0"""
+    from .sketch import CountMinSketch # Imported on demand as it needs numpy
+    sketch = CountMinSketch()
+    sketch.update([ qid for qid, _ in data if qid != 0 ], [ v for qid, v in data if qid != 0 ])
+    return sketch
+
+
+class Writer:
+    """Base class for bulk-write backends
+
+    Args:
+        database: Database name
+        chunk_size: Number of rows to send at once
+        top_n: Number of heavy hitters to keep for each hour
+    """
+    default_chunk_size = 100000
+
+    def __init__(self, database, chunk_size=None, top_n=DEFAULT_TOP_N):
+        self.database = database
+        self.chunk_size = chunk_size or self.default_chunk_size
+        self.top_n = top_n
+
+    def connect(self):
+        return connect(self.database)
+
+    def exists(self, filename):
+        """Returns true iff there is already a record for this filename"""
+        with self.connect() as cursor:
+            cursor.execute(self.exists_sql, (filename,))
+            return cursor.fetchone() is not None
+
+    exists_sql = "SELECT 1 FROM hours WHERE file = %s"
+
+    def existing(self, filenames):
+        """Returns the subset of filenames that already have a record, using one query"""
+        filenames = list(filenames)
+        if not filenames:
+            return set()
+        placeholders = ", ".join([self.placeholder] * len(filenames))
+        with self.connect() as cursor:
+            cursor.execute(f"SELECT file FROM hours WHERE file IN ({placeholders})", filenames)
+            return { file for (file,) in cursor.fetchall() }
+
+    placeholder = "%s"
+
+    def write_hour(self, filename, hour, qid_views, start_time, unresolved=None,
+                   replace_hour=False):
+        """Write results for one hour
+
+        Rows are written in primary key order, and replace any existing rows,
+        so that a retry after a partial write does not fail.
+
+        Args:
+            filename: Name of log file processed
+            hour: YYYY-MM-DDTHH:00:00 formatted hour
+            qid_views: Iterable of QID and view count pairs, each QID at most once
+            start_time: time.time() object from start of run
+            unresolved: Optional ``SpaceSaving`` sketch of unresolved (dbname, title) pairs
+            replace_hour: Delete any existing rows for the hour first, e.g. when remapping;
+                the ``hours`` row is then flagged as ``remapped``
+        """
+        logger = logging.getLogger(__name__)
+        data = sorted(qid_views)
+        n_qids = len(data)
+        max_qid = data[-1][0] if data else 0
+        views = sum(v for _, v in data)
+        hour = sql_hour(hour)
+        with self.connect() as cursor:
+            if replace_hour:
+                cursor.execute(self.delete_hour_sql, (hour,))
+            for chunk in chunks(data, self.chunk_size):
+                self.write_rows(cursor, [ (qid, hour, v) for qid, v in chunk ])
+            cursor.execute(self.delete_top_sql, (hour,))
+            cursor.executemany(self.top_sql,
+                               [ (hour, qid, v) for qid, v in heavy_hitters(data, self.top_n) ])
+            cursor.execute(self.delete_unresolved_sql, (hour,))
+            if unresolved is not None:
+                rows = []
+                for (dbname, title), v, error in unresolved.top():
+                    title = title.encode()
+                    rows.append((hour, dbname.encode(), title_hash(title), title, v, error))
+                cursor.executemany(self.unresolved_sql, rows)
+            sketch = hour_sketch(data)
+            cursor.execute(self.sketch_sql, (hour, sketch.width, sketch.depth, sketch.to_bytes()))
+            duration = time.time() - start_time
+            row = (filename, hour, utc_timestamp(), int(duration), views, max_qid, n_qids,
+                   int(replace_hour))
+            logger.info(f"{type(self).__name__}: hours row {row}")
+            cursor.execute(self.hours_sql, row)
+
+    delete_hour_sql = "DELETE FROM qid_hourly_views WHERE hour = %s"
+    delete_top_sql = "DELETE FROM hourly_top WHERE hour = %s"
+    top_sql = "INSERT INTO hourly_top (hour, qid, views) VALUES (%s, %s, %s)"
+
+    delete_unresolved_sql = "DELETE FROM hourly_unresolved WHERE hour = %s"
+    unresolved_sql = dedent("""
+        INSERT INTO hourly_unresolved (hour, dbname, title_hash, title, views, error)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """).strip()
+
+    sketch_sql = dedent("""
+        REPLACE INTO hourly_sketch (hour, width, depth, counts)
+        VALUES (%s, %s, %s, %s)
+    """).strip()
+
+    hours_sql = dedent("""
+        REPLACE INTO hours (file, hour, processed, duration, views, max_qid, n_qids, remapped)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    """).strip()
+
+    rows_sql = dedent("""
+        REPLACE INTO qid_hourly_views (qid, hour, views)
+        VALUES (%s, %s, %s)
+    """).strip()
+
+    def write_rows(self, cursor, rows):
+        """Write a chunk of (qid, hour, views) rows"""
+        cursor.executemany(self.rows_sql, rows)
+
+
+class LoadDataWriter(Writer):
+    """Uses ``LOAD DATA LOCAL INFILE`` via ``batch_insert``"""
+    def connect(self):
+        return connect(self.database, local_infile=1)
+
+    def write_rows(self, cursor, rows):
+        batch_insert(cursor, 'qid_hourly_views', rows, replace=True)
+
+
+class InsertWriter(Writer):
+    """Uses multi-row ``REPLACE INTO ... VALUES`` statements"""
+    default_chunk_size = 10000
+
+
+class SQLiteWriter(Writer):
+    """Writes to a local SQLite file named like ``sqlite:PATH``"""
+    exists_sql = Writer.exists_sql.replace('%s', '?')
+    placeholder = '?'
+    delete_hour_sql = Writer.delete_hour_sql.replace('%s', '?')
+    delete_top_sql = Writer.delete_top_sql.replace('%s', '?')
+    top_sql = Writer.top_sql.replace('%s', '?')
+    delete_unresolved_sql = Writer.delete_unresolved_sql.replace('%s', '?')
+    unresolved_sql = Writer.unresolved_sql.replace('%s', '?')
+    sketch_sql = Writer.sketch_sql.replace('%s', '?')
+    hours_sql = Writer.hours_sql.replace('%s', '?')
+    rows_sql = dedent("""
+        INSERT OR REPLACE INTO qid_hourly_views (qid, hour, views)
+        VALUES (?, ?, ?)
+    """).strip()
+
+    def connect(self):
+        return _sqlite_cursor(sqlite_path(self.database))
+
+
+def _archive_writer(database, **kargs):
+    """Imported on demand as ``archive`` depends on this module"""
+    from .archive import ArchiveWriter
+    return ArchiveWriter(database, **kargs)
+
+
+WRITERS = {
+    'load-data': LoadDataWriter,
+    'insert': InsertWriter,
+    'sqlite': SQLiteWriter,
+    'archive': _archive_writer,
+}
+
+
+def get_writer(database, backend=None, chunk_size=None, top_n=DEFAULT_TOP_N):
+    """Choose a writer for a database
+
+    Args:
+        database: Database name, or ``sqlite:PATH``
+        backend: One of the keys of ``WRITERS``;
+            defaults to ``sqlite``, ``archive`` or ``load-data`` according to the database name
+        chunk_size: Number of rows to send at once
+        top_n: Number of heavy hitters to keep for each hour
+
+    Returns:
+        writer: ``Writer`` object
+    """
+    default = 'sqlite' if is_sqlite(database) \
+        else 'archive' if database.startswith('archive:') else 'load-data'
+    if backend is None:
+        backend = default
+    # The MariaDB backends are interchangeable, but the others need their own prefix
+    assert backend == default or {backend, default} <= {'load-data', 'insert'}, \
+        f"The {backend} writer cannot write to {database}"
+    return WRITERS[backend](database, chunk_size=chunk_size, top_n=top_n)